@@ -9,25 +9,34 @@ This script creates communication interface utilizing imagezmq and its API from
 The communication interface is created as follows:
     User runs the script and is greeted by choosing a camera
     Then he chooses number of connections he wishes to establish
-    Then he chooses the port numbers and modes(REQ_REP/SUB_PUB) to be used
+    Then he chooses the port numbers and modes(REQ_REP/PUB_SUB/DEALER_ROUTER) to be used
     Accordingly, these connections will be established
-    TODO: multithreading so that there can be multiple REQ_REPs
+    DEALER_ROUTER keeps several frames in flight, so a high-latency hub
+    does not cap the camera at one round-trip per frame
     An infinite loop will send these data streams from camera
+    Senders to remote hubs can compress frames to jpg, adapting the quality
+    and resolution to the link
+    Every sender runs in its own worker thread with a bounded queue that drops
+    the oldest frame, so one slow hub does not stall the other connections
 
 """
 
+import collections
 import socket
+import threading
 import time
 from imutils.video import VideoStream
 import imagezmq_modified as imagezmq
 
-def init_sender(address,mode):
+MODES = ("REQ_REP", "PUB_SUB", "DEALER_ROUTER")
+
+def init_sender(address, mode, window=4, compress=False):
     if not type(mode) == str:
         raise TypeError("Mode must be a string.")
     if not type(address) == str:
         raise TypeError("Adress must be a string.")
-    print(f"Establishing connection {adress} with REQ_REP={mode}")
-    sender = imagezmq.ImageSender(connect_to=address,REQ_REP=mode)
+    print(f"Establishing connection {address} with mode={mode}, compress={compress}")
+    sender = imagezmq.ImageSender(connect_to=address, mode=mode, window=window, compress=compress)
     return sender
 
 def user_interface_cam_ncon():
@@ -41,15 +50,15 @@ def user_interface_cam_ncon():
 
 def user_interface_add_mode(ncon, senders):
     for con in range(ncon):
-        address = str(input(f"-----------------\nAddress of {con+1}. connection\n (eg.: tcp://localhost:5555) for REQ_REP\n (eg.: tcp://*:5555) for SUB_PUB\n"))
-        mode = str(input("Mode of connection (REQ_REP, SUB_PUB):"))
-        if mode == "True":
-            mode = True
-        elif mode == "False":
-            mode = False
-        else:
-            raise TypeError("Mode must be either True or False.")
-        sender = init_sender(address, mode)
+        address = str(input(f"-----------------\nAddress of {con+1}. connection\n (eg.: tcp://localhost:5555) for REQ_REP/DEALER_ROUTER\n (eg.: tcp://*:5555) for PUB_SUB\n"))
+        mode = str(input("Mode of connection (REQ_REP, PUB_SUB, DEALER_ROUTER):"))
+        if mode not in MODES:
+            raise TypeError(f"Mode must be one of {MODES}.")
+        window = 4
+        if mode == "DEALER_ROUTER":
+            window = int(input("Frames in flight (default 4):") or 4)
+        compress = str(input("Send jpg compressed frames, for remote hubs (y/N):")).lower() == "y"
+        sender = init_sender(address, mode, window, compress)
         senders.append(sender)
     return senders
 
@@ -59,20 +68,142 @@ def add_mode_default():
                 imagezmq.ImageSender(connect_to='tcp://*:5550',mode='PUB_SUB')]
     return senders
 
+class SenderWorker(threading.Thread):
+    """A thread that owns one sender and feeds it from a bounded queue.
+
+    Attributes:
+        sender:                 The ImageSender instance (used only by this thread)
+        queue:                  Deque of (name, image) waiting to be sent
+        delivered:              Number of frames handed over to the sender
+        dropped:                Number of frames dropped because the queue was full
+                                or the sender failed
+        error:                  Message of the exception that stopped the sender, None while it works
+
+    Methods:
+        put:                    Queues a frame, drops the oldest one if the queue is full
+        run:                    Sends queued frames until stopped or the sender fails
+        stop:                   Stops the thread and closes the sender
+    """
+
+    def __init__(self, sender, maxlen=2):
+        """Initializes the thread with its sender and queue length."""
+        super().__init__(daemon=True)
+        self.sender = sender
+        self.queue = collections.deque(maxlen=maxlen)
+        self.cond = threading.Condition()
+        self.running = True
+        self.delivered = 0
+        self.dropped = 0
+        self.error = None
+
+    def put(self, name, image):
+        """Queues a frame, never blocks the caller."""
+        with self.cond:
+            if self.error is not None:
+                self.dropped += 1
+                return
+            if len(self.queue) == self.queue.maxlen:
+                self.dropped += 1
+            self.queue.append((name, image))
+            self.cond.notify()
+
+    def run(self):
+        """Sends queued frames until stopped.
+
+        A failing send stops the thread: the error is recorded for stats,
+        the queued frames are counted as dropped and the sender is closed.
+        """
+        try:
+            while True:
+                with self.cond:
+                    while self.running and not self.queue:
+                        self.cond.wait()
+                    if not self.running:
+                        break
+                    name, image = self.queue.popleft()
+                self.sender.send_image(name, image)
+                self.delivered += 1
+        except Exception as error:
+            with self.cond:
+                self.error = repr(error)
+                self.dropped += len(self.queue) + 1
+                self.queue.clear()
+            print(f"Sender {self.sender.mode} failed: {self.error}")
+        finally:
+            self.sender.close()
+
+    def stop(self):
+        """Stops the thread, the sender is closed from the thread itself."""
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+
+class FanOut:
+    """Distributes every camera frame to all senders without waiting for them.
+
+    Attributes:
+        workers:                List of SenderWorker instances, one per sender
+
+    Methods:
+        publish:                Queues the frame for every sender
+        stats:                  Returns delivered/dropped counters and the error per sender
+        stop:                   Stops all workers
+    """
+
+    def __init__(self, senders, maxlen=2):
+        """Creates and starts one worker per sender."""
+        self.workers = [SenderWorker(sender, maxlen) for sender in senders]
+        for worker in self.workers:
+            worker.start()
+
+    def publish(self, name, image):
+        """Queues the frame for every sender."""
+        for worker in self.workers:
+            worker.put(name, image)
+
+    def stats(self):
+        """Returns a list of (mode, delivered, dropped, error) for every sender."""
+        return [(w.sender.mode, w.delivered, w.dropped, w.error) for w in self.workers]
+
+    def stop(self, timeout=1.0):
+        """Stops all workers, waits at most timeout seconds for each."""
+        for worker in self.workers:
+            worker.stop()
+        for worker in self.workers:
+            worker.join(timeout)
+
+def main():
+    senders = []
+    cam_number, ncon = user_interface_cam_ncon()
+    if cam_number == "":
+        senders = add_mode_default()
+        cam_number = 0
+    else:
+        senders = user_interface_add_mode(ncon, senders)
+    name = socket.gethostname()
+    cam = VideoStream(src=cam_number).start()
+    print("\nCamera active")
+    time.sleep(2.0)
+    print("\nSending data")
+    fanout = FanOut(senders)
+    last_image = None
+    try:
+        while True:
+            image = cam.read()
+            if image is last_image:
+                # VideoStream returns the same frame until a new one is captured
+                time.sleep(0.001)
+                continue
+            last_image = image
+            fanout.publish(name, image)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        cam.stop()
+        fanout.stop()
+        for mode, delivered, dropped, error in fanout.stats():
+            print(f"{mode}: delivered {delivered}, dropped {dropped}"
+                  + (f", failed with {error}" if error is not None else ""))
 
-senders = []
-cam_number, ncon = user_interface_cam_ncon()
-if cam_number == "":
-    senders = add_mode_default()
-    cam_number = 0
-else:
-    senders = user_interface_add_mode(ncon, senders)
-name = socket.gethostname()
-cam = VideoStream(src=cam_number).start()
-print("\nCamera active")
-time.sleep(2.0)
-print("\nSending data")
-while True:
-    image = cam.read()
-    for sender in senders:
-        sender.send_image(name, image)
+if __name__ == "__main__":
+    main()
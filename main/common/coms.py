@@ -14,9 +14,27 @@ Typical usage:
     name_dict = {}
     com_dict = {}
     coms.create_parameter(bundle,name_dict,com_dict)
+
+    Many parameters share one ParameterBus instead of a connection each:
+    bus = coms.ParameterBus('send', port=coms.PARAMETER_PORT)
+    params = coms.bundle_parameters([bundle], bus)
 """
 import socket
-import imagezmq_modified as imagezmq
+import struct
+import threading
+
+import numpy as np
+import zmq
+
+try:
+    from main.qtdashboard import imagezmq_modified as imagezmq
+except ImportError:
+    import imagezmq_modified as imagezmq
+
+#Version and value of one parameter record, after its length-prefixed name
+RECORD_STRUCT = struct.Struct('<Id')
+#Port of the ParameterBus, unprivileged and next to the stage feeds (5560-5563)
+PARAMETER_PORT = 5564
 
 class ComInst:
     """An object initializing the communication instance.
@@ -24,7 +42,8 @@ class ComInst:
     Attributes:
         direction:              Either 'send' or 'recv', determines client/server instance
         port:                   4digit number that serves as the port number
-        mode:                   Either 'REQ_REP' or 'PUB_SUB', determines communication
+        mode:                   Either 'REQ_REP', 'PUB_SUB' or 'DEALER_ROUTER', determines communication
+        conflate:               Boolean, PUB_SUB receivers only, keep just the newest frame
         address:                An address for creation of communication instance
         instance:               The communication object instance
         name:                   Gets the hostname of the machine
@@ -37,16 +56,20 @@ class ComInst:
         address_recv:           Creates a valid client address
         connect_send:           Creates a server communication object
         connect_recv:           Creates a client communication object
+        poll:                   Waits for a message to receive, with a timeout
+        get_latest:             Returns the newest frame of a conflating receiver, with a timeout
+        is_open:                Checks that the socket was not closed
 
     Raises:
         ValueError                  When an invalid input has been detected
     """
 
-    def __init__(self, direction, port, mode):
+    def __init__(self, direction, port, mode, conflate=False):
         """Initializes the class and calls its methods."""
         self.direction = direction      #either 'send' or 'recv'
         self.port = port                #4digit number
-        self.mode = mode                #either 'REQ_REP' or 'PUB_SUB'
+        self.mode = mode                #either 'REQ_REP', 'PUB_SUB' or 'DEALER_ROUTER'
+        self.conflate = conflate        #only a 'recv' 'PUB_SUB' instance can conflate
         self.instance = None
         self.name = socket.gethostname()
         self.address = None
@@ -60,8 +83,10 @@ class ComInst:
             raise ValueError("Invalid direction argument, must be 'send' or 'recv'")
         if int(self.port) > 9999:
             raise ValueError("Invalid port number, use 4digit integer")
-        if self.mode != "REQ_REP" and self.mode != "PUB_SUB":
-            raise ValueError("Invalid mode argument, must be 'REQ_REP' or 'PUB_SUB'")
+        if self.mode not in ("REQ_REP", "PUB_SUB", "DEALER_ROUTER"):
+            raise ValueError("Invalid mode argument, must be 'REQ_REP', 'PUB_SUB' or 'DEALER_ROUTER'")
+        if self.conflate and (self.direction != 'recv' or self.mode != 'PUB_SUB'):
+            raise ValueError("Only a 'recv' instance in 'PUB_SUB' mode can conflate")
 
     def create_address(self):
         """Chooses the right address creator."""
@@ -81,14 +106,14 @@ class ComInst:
 
     def address_send(self):
         """Creates a valid server address."""
-        if self.mode == 'REQ_REP':
+        if self.mode in ('REQ_REP', 'DEALER_ROUTER'):
             self.address = 'tcp://localhost:' + str(self.port)
         elif self.mode == 'PUB_SUB':
             self.address = 'tcp://*:' + str(self.port)
 
     def address_recv(self):
         """Creates a valid client address."""
-        if self.mode == 'REQ_REP':
+        if self.mode in ('REQ_REP', 'DEALER_ROUTER'):
             self.address = 'tcp://*:' + str(self.port)
         elif self.mode == 'PUB_SUB':
             self.address = 'tcp://localhost:' + str(self.port)
@@ -99,7 +124,7 @@ class ComInst:
 
     def connect_recv(self):
         """Creates a client communication object."""
-        self.instance = imagezmq.ImageHub(open_port=self.address, mode=self.mode)
+        self.instance = imagezmq.ImageHub(open_port=self.address, mode=self.mode, conflate=self.conflate)
 
     def send(self, msg):
         """Checks whether the instance can send, if it does, send a message."""
@@ -116,9 +141,26 @@ class ComInst:
         else:
             raise TypeError("This object is not able to receive a message")
 
+    def poll(self, timeout=None):
+        """Checks whether the instance can receive, if it does, waits at most timeout ms for a message."""
+        if self.direction == 'recv':
+            return self.instance.zmq_socket.poll(timeout) != 0
+        else:
+            raise TypeError("This object is not able to receive a message")
+
+    def get_latest(self, timeout=None):
+        """Checks whether the instance conflates, if it does, waits at most timeout ms for a newer frame.
+
+        Returns (None, None) when no newer frame arrived within timeout.
+        """
+        if self.conflate:
+            return self.instance.get_latest(None if timeout is None else timeout/1000)
+        else:
+            raise TypeError("This object does not conflate, use poll and recv")
+
     def send_reply(self, msg=b'OK'):
-        """Checks whether the instance can receive and is in REQ_REP mode. If so, sends a reply."""
-        if self.direction == 'recv' and self.mode == 'REQ_REP':
+        """Checks whether the instance can receive and is in REQ_REP/DEALER_ROUTER mode. If so, sends a reply."""
+        if self.direction == 'recv' and self.mode in ('REQ_REP', 'DEALER_ROUTER'):
             self.instance.send_reply(msg)
         else:
             raise TypeError("This object is not able to send a reply")
@@ -127,19 +169,32 @@ class ComInst:
         """Closes the communication instance."""
         self.instance.close()
 
+    def is_open(self):
+        """Returns True while the communication instance has an open socket."""
+        return self.instance is not None and not self.instance.zmq_socket.closed
+
 class Parameters:
     """An object initializing the parameters.
 
+    Values are set from change events (e.g. Qt valueChanged signals), a burst
+    of changes is coalesced and only the changed keys are sent on flush,
+    each with a version number increasing with every sent value.
+
     Attributes:
         pars:               Dictionary of settable parameters and their current values
-        def_pars:           Dictionary of default parameters (set at init) and their current value
+        last_pars_value:    Dictionary of the last sent value of every parameter (a copy of pars at init)
         coms:               Dictionary with setted connection instance for each parameter key
-        update_flag:         Dictionary with boolean corresponding to change of parameter value
+        bus:                ParameterBus sending all parameters, used instead of coms when given;
+                            without both, parameters are only tracked, not sent
+        versions:           Dictionary of the version number of the last sent value of every parameter
+        changed:            Dictionary (ordered set) of the keys changed since the last flush
 
     Methods:
-        detect_update:
-        update_last_pars:
-        update_pars:
+        set:                Sets a parameter from a change event
+        detect_updates:     Marks parameters written directly into pars as changed
+        flush:              Sends the changed parameters with their versions
+        send_parameters:    Same as flush
+        close:              Closes all connection instances
 
     Raises:
         ValueError:         When an invalid input has been detected
@@ -147,56 +202,307 @@ class Parameters:
     Typical use:
         INIT
         pars = Parameters(pars,coms)
-        IN LOOP
-        pars.detect_updates()
-        pars.update_parameters()
+        ON EVENT
+        pars.set("prepro_BRIGHTNESS", 0.5)
+        ONCE THE BURST OF EVENTS IS PROCESSED
+        pars.flush()
     """
 
-    def __init__(self, pars, coms):
+    def __init__(self, pars, coms=None, bus=None):
         """Initiates the Parameters class."""
         self.pars = pars
-        self.last_pars_value = pars
-        self.coms = coms
-        self.update_flag = None
+        self.last_pars_value = dict(pars)
+        self.coms = coms or {}
+        self.bus = bus
+        self.versions = {k: 0 for k in pars}
+        self.changed = {}
+
+    def set(self, key, value):
+        """Sets a parameter, it is sent on the next flush if it differs from the last sent value."""
+        if key not in self.pars:
+            raise ValueError(f"{key} is not a parameter")
+        self.pars[key] = value
+        if value != self.last_pars_value[key]:
+            self.changed[key] = None
+        else:
+            #changed back before the flush, nothing to send
+            self.changed.pop(key, None)
 
     def detect_updates(self):
-        """Detects changes between last_pars_values and pars_values."""
-        self.update_flag = {}
+        """Detects changes between last_pars_values and pars_values, for values written into pars directly."""
         for k, value in self.pars.items():
-            if self.pars[k] != self.last_pars_value[k]:
-                self.update_flag[k] = True
-                self.last_pars_value.update(k=value)
-            elif self.pars[k] == self.last_pars_value[k]:
-                self.update_flag[k] = False
+            if value != self.last_pars_value[k]:
+                self.changed[k] = None
+
+    def flush(self):
+        """Sends every changed parameter once, as [version, value].
+
+        With a bus, all of them are published in one batch per topic.
+
+        Returns:
+            sent:           Dictionary of the sent keys and their (version, value)
+        """
+        sent = {}
+        for k in self.changed:
+            value = self.pars[k]
+            self.versions[k] += 1
+            if self.bus is None and k in self.coms:
+                self.coms[k].send(np.array([self.versions[k], value], dtype=np.float64))
+            self.last_pars_value[k] = value
+            sent[k] = (self.versions[k], value)
+        if self.bus is not None and sent:
+            self.bus.publish(sent)
+        self.changed = {}
+        return sent
 
     def send_parameters(self):
-        """Send those parameters that have their update_flag equal to True."""
-        for k, com_inst in self.coms.items():
-            if self.update_flag[k] is True:
-                com_inst.send()
+        """Sends the changed parameters, see flush."""
+        return self.flush()
+
+    def close(self):
+        """Closes the connection instance of every parameter, a bus is closed by its owner."""
+        for com_inst in self.coms.values():
+            com_inst.close()
+
+class ParameterBus:
+    """One multiplexed PUB_SUB channel carrying any number of parameters.
+
+    Every message is [topic, records]: the topic is the parameter name up to
+    its first underscore (e.g. b'prepro' for prepro_BRIGHTNESS), so receivers
+    subscribe to parameter groups. Records are packed back to back as
+    name length (1 byte), name, version (uint32) and value (float64).
+    All buses of a process share one zmq.Context.
+
+    Attributes:
+        direction:          Either 'send' (PUB, binds) or 'recv' (SUB, connects)
+        port:               4digit number that serves as the port number
+        address:            An address for creation of communication instance
+        zmq_socket:         The only socket of the bus
+
+    Methods:
+        topic:              Returns the topic of a parameter name
+        encode:             Packs {name: (version, value)} into records
+        decode:             Unpacks records into {name: (version, value)}
+        publish:            Sends updates, one message per topic
+        poll:               Waits for a message to receive, with a timeout
+        recv:               Receives one batch of updates
+        is_open:            Checks that the socket was not closed
+        close:              Closes the socket
+
+    Raises:
+        ValueError:         When an invalid input has been detected
+    """
+
+    def __init__(self, direction, port=PARAMETER_PORT, topics=(b'',)):
+        """Initializes the bus, a receiver subscribes to the given topics (all by default)."""
+        if direction != 'send' and direction != 'recv':
+            raise ValueError("Invalid direction argument, must be 'send' or 'recv'")
+        if int(port) > 9999:
+            raise ValueError("Invalid port number, use 4digit integer")
+        self.direction = direction
+        self.port = port
+        context = zmq.Context.instance()
+        if direction == 'send':
+            self.address = 'tcp://*:' + str(port)
+            self.zmq_socket = context.socket(zmq.PUB)
+            try:
+                self.zmq_socket.bind(self.address)
+            except zmq.ZMQError as error:
+                self.zmq_socket.close()
+                raise OSError(f"Parameter bus can not bind {self.address}: {error}") from error
+        else:
+            self.address = 'tcp://localhost:' + str(port)
+            self.zmq_socket = context.socket(zmq.SUB)
+            for topic in topics:
+                self.zmq_socket.setsockopt(zmq.SUBSCRIBE, topic)
+            self.zmq_socket.connect(self.address)
+
+    @staticmethod
+    def topic(name):
+        """Returns the topic of a parameter name, its part before the first underscore."""
+        return name.split('_', 1)[0].encode()
+
+    @staticmethod
+    def encode(updates):
+        """Packs a dictionary of name and (version, value) into records."""
+        records = []
+        for name, (version, value) in updates.items():
+            name = name.encode()
+            records.append(bytes((len(name),)) + name + RECORD_STRUCT.pack(int(version), float(value)))
+        return b''.join(records)
+
+    @staticmethod
+    def decode(payload):
+        """Unpacks records into a dictionary of name and (version, value)."""
+        updates = {}
+        offset = 0
+        while offset < len(payload):
+            length = payload[offset]
+            name = bytes(payload[offset + 1:offset + 1 + length]).decode()
+            offset += 1 + length
+            updates[name] = RECORD_STRUCT.unpack_from(payload, offset)
+            offset += RECORD_STRUCT.size
+        return updates
+
+    def publish(self, updates):
+        """Sends a dictionary of name and (version, value), batched into one message per topic."""
+        if self.direction != 'send':
+            raise TypeError("This object is not able to send a message.")
+        batches = {}
+        for name, record in updates.items():
+            batches.setdefault(self.topic(name), {})[name] = record
+        for topic, batch in batches.items():
+            self.zmq_socket.send_multipart([topic, self.encode(batch)])
+
+    def poll(self, timeout=None):
+        """Waits at most timeout ms for a message, returns True when one can be received."""
+        return self.zmq_socket.poll(timeout) != 0
+
+    def recv(self):
+        """Receives one batch, returns a dictionary of name and (version, value)."""
+        if self.direction != 'recv':
+            raise TypeError("This object is not able to receive a message")
+        __, payload = self.zmq_socket.recv_multipart(copy=False)
+        return self.decode(payload.buffer)
+
+    def is_open(self):
+        """Returns True while the socket was not closed."""
+        return not self.zmq_socket.closed
+
+    def close(self):
+        """Closes the socket, the shared context stays open."""
+        self.zmq_socket.close(linger=0)
+
+class ResourceManager:
+    """An object keeping communication instances and capture devices open.
+
+    Resources are registered with a factory and created on first use, then
+    reused by every later get. A resource failing its health check is closed
+    and created again. All resources are closed together on close_all.
+    Every key has its own lock, so threads using different resources, e.g.
+    the workers of several feeds, never wait for each other.
+
+    Attributes:
+        factories:          Dictionary of key and callable creating the resource
+        checks:             Dictionary of key and callable(resource) returning True when healthy
+        closers:            Dictionary of key and callable(resource) closing the resource
+        resources:          Dictionary of key and the created resource
+        key_locks:          Dictionary of key and the lock guarding its resource
 
-def create_parameter(bundle, names, coms):
-    """Takes an established names(dict) and coms(dict) and updates it with data from bundle(dict)"""
+    Methods:
+        register:           Registers how to create, check and close a resource
+        get:                Returns the resource, creates it when missing or unhealthy
+        check:              Runs the health check of a created resource
+        release:            Closes one resource, it is created again on the next get
+        close_all:          Closes all created resources
+
+    Raises:
+        KeyError:           When getting a resource that was not registered
+
+    Typical use:
+        resources = ResourceManager()
+        resources.register("image_hub", lambda: ComInst('recv', 5555, 'REQ_REP'),
+                           check=ComInst.is_open)
+        hub = resources.get("image_hub")
+        resources.close_all()
+    """
+
+    def __init__(self):
+        """Initiates the ResourceManager class."""
+        self.factories = {}
+        self.checks = {}
+        self.closers = {}
+        self.resources = {}
+        self.key_locks = {}
+        self.lock = threading.Lock()
+
+    def register(self, key, factory, check=None, close=None):
+        """Registers how to create, check and close a resource, nothing is created yet.
+
+        Without close the resource's close() method is used, or release() when it has none.
+        """
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, threading.RLock())
+        with key_lock:
+            self.factories[key] = factory
+            self.checks[key] = check
+            self.closers[key] = close
+
+    def get(self, key):
+        """Returns the resource, creates it when missing or when it fails its health check."""
+        key_lock = self.key_locks.get(key)
+        if key_lock is None:
+            raise KeyError(f"{key} is not registered")
+        with key_lock:
+            if key in self.resources and not self.check(key):
+                self.release(key)
+            if key not in self.resources:
+                self.resources[key] = self.factories[key]()
+            return self.resources[key]
+
+    def check(self, key):
+        """Returns True when the resource exists and passes its health check."""
+        if key not in self.key_locks:
+            return False
+        with self.key_locks[key]:
+            if key not in self.resources:
+                return False
+            check = self.checks[key]
+            if check is None:
+                return True
+            try:
+                return bool(check(self.resources[key]))
+            except Exception:
+                return False
+
+    def release(self, key):
+        """Closes one resource, it is created again on the next get."""
+        if key not in self.key_locks:
+            return
+        with self.key_locks[key]:
+            resource = self.resources.pop(key, None)
+            if resource is None:
+                return
+            close = self.closers[key]
+            if close is None:
+                close = getattr(resource, "close", None) or getattr(resource, "release")
+                close()
+            else:
+                close(resource)
+
+    def close_all(self):
+        """Closes all created resources, in reverse order of creation."""
+        with self.lock:
+            keys = list(self.resources)
+        for key in reversed(keys):
+            self.release(key)
+
+def create_parameter(bundle, names, coms, bus=None):
+    """Takes an established names(dict) and coms(dict) and updates it with data from bundle(dict)
+
+    With a bus no connection is created, only name and value are read from the bundle.
+    """
     name = bundle["name"]
     if name in names:
         raise ValueError(f"{name} is already present")
     value = bundle["value"]
+    names.update({name:value})
+    if bus is not None:
+        return
     direction = bundle["direction"]
     port = bundle["port"]
     mode = bundle["mode"]
     #instanciate
     cominst = ComInst(direction, port, mode)
-    par_dict = {name:value}
     coms_dict = {name:cominst}
     #update the given values
-    names.update(par_dict)
     coms.update(coms_dict)
 
-def bundle_parameters(bundles):
+def bundle_parameters(bundles, bus=None):
     """Handles the creation of parameters and communication dictionaries."""
     par_dict = {}
     com_dict = {}
     for bundle in bundles:
-        create_parameter(bundle, par_dict, com_dict)
-    params = Parameters(par_dict, com_dict)
+        create_parameter(bundle, par_dict, com_dict, bus)
+    params = Parameters(par_dict, com_dict, bus)
     return params
@@ -16,12 +16,14 @@ use. These include:
   Typical usage example:
 
   det = Detection(detection_data,softmax_prediction,button_width,button_height)
-  TODO:
+  results = process_panels([detection_data, ...], processes=4)
 """
-from math import floor as rounddown
+import logging
 
 import numpy as np
 
+logger = logging.getLogger(__name__)
+
 #TESTDATA
 dtype = [('x', float),( 'y', float),( 'n', int)]
 data = np.array([(0.625,0.11,1),
@@ -44,20 +46,22 @@ class Detection:
 
     Attributes:
         detected:                   An array of given data from recognition
-        buttons_raw:                List of Button classes based on given data
+        buttons_raw:                Button table (BUTTON_DTYPE structured array) based on given data
         template:                   Template object, corrects button sequence
         panel:                      Panel object
+        row_labels:                 Numpy array of the row of every detection
+        col_labels:                 Numpy array of the column of every detection
+        rows:                       List of lists of detection indices, one per row, bottom to top
+        cols:                       List of lists of detection indices, one per column, left to right
         but:                        List of detected button parameters
-        adj_cooef: TODO:            A cooeficient for moving the comparison value for imperfect/real positions
         softmax_pred:               A list of lists of x',x'',x''' prediction of label of buttons from given data
 
     Methods:
-        create_buttons_raw:         Creates a list of Button objects from raw data
+        create_buttons_raw:         Creates the button table from raw data
         create_panel:               Creates a slave Panel object
         create_template:            Creates a slave Template object
-        find_classes(axis = 1/0):   Finds buttons along the same row/column
-        order_unique_coord(coord, history, type = "rows"/"cols"): 
-                                    Rearanges rows and columns based on their average position in space
+        find_classes(axis = "row"/"col"):
+                                    Finds buttons along the same row/column, ordered by position
     """
 
     def __init__(self, detected, softmax_pred, but_w, but_h):
@@ -67,7 +71,6 @@ class Detection:
         self.template = None
         self.panel = None
         self.but = (but_w,but_h)
-        self.adj_cooef = 1
         self.softmax_pred = softmax_pred
 
         self.create_buttons_raw()
@@ -75,23 +78,21 @@ class Detection:
         self.create_panel()
         
     def create_buttons_raw(self):
-        """Creates a list of button objects based on raw data."""
-        button_list = []
-        for i in self.detected:
-            x_raw, y_raw, n_raw = i[0], i[1], i[2]
-            button_list.append(Button(x_raw,y_raw,n_raw))
-        self.buttons_raw = button_list
+        """Creates the button table based on raw data."""
+        self.buttons_raw = button_table(detection_column(self.detected, 0),
+                                        detection_column(self.detected, 1),
+                                        detection_column(self.detected, 2))
 
     def create_template(self):
         """Creates a template object."""
-        rows, rows_all, r_val_hist = self.find_classes("row")
-        cols, cols_all, c_val_hist = self.find_classes("col")
+        __, rows = self.find_classes("row")
+        __, cols = self.find_classes("col")
 
-        if len(rows) > 1/but_h: raise ValueError("There can't be more rows than can physically fit into statespace")
-        if len(cols) > 1/but_w: raise ValueError("There can't be more cols than can physically fit into statespace")
+        if len(rows) > 1/self.but[1]: raise ValueError("There can't be more rows than can physically fit into statespace")
+        if len(cols) > 1/self.but[0]: raise ValueError("There can't be more cols than can physically fit into statespace")
 
-        self.rows_ordered = self.order_unique_coord(rows_all, r_val_hist, "row")
-        self.cols_ordered = self.order_unique_coord(cols_all, c_val_hist, "col")
+        self.rows_ordered = rows
+        self.cols_ordered = cols
 
         self.template = Template(self.buttons_raw, self.softmax_pred, self.rows_ordered, self.cols_ordered)
     
@@ -107,10 +108,10 @@ class Detection:
             axis:                   String ("row"/"col") that depends upon if we want to find rows or cols
 
         Returns:
-            sames_unique:           Numpy sorted array of unique classes
-            sames:                  Numpy array of found classes
-            comp_val_history:       List of average values of y_raw (for rows)/ x_raw(for cols) 
-                                    for each member, used to differenciate classes
+            labels:                 Numpy array of the row/column of every detection,
+                                    numbered from bottom (for rows)/ left (for cols)
+            classes:                List of lists of detection indices, one per row/column, ordered
+                                    by position, members in detection order
         """
         if axis == "row": 
             axis = 1
@@ -119,65 +120,45 @@ class Detection:
         else: 
             raise NameError("argument must be row or col")
 
-        i = -1
-        sames = []
-        comp_val_history = []
-
-        for _ in self.detected:
-            same_class = []
-            j = -1
-
-            i +=1
-            compare_val = self.detected[i][axis]
-
-            for d in self.detected:
-                j +=1
-                val = d[axis]
-                if abs(val-compare_val) < self.but[axis]/2:
-                    same_class.append(j)
-                    compare_val = compare_val + (val-compare_val)/self.adj_cooef
-
-            sames.append(same_class)
-            comp_val_history.append(rounddown(compare_val*10)) #Important to sorting the columns based on y_axis
-
-        sames = np.array(sames)
-        sames_unique = np.unique(sames)
-
-        return sames_unique, sames, comp_val_history
-
-    def order_unique_coord(self,coord,comp_hist,type):
-        """Rearanges rows/cols based on their position and eliminates duplicities.
-
-        Args:
-            coord:      List of lists of all detected rows/columns
-            comp_hist:  List of average values of y_raw (for rows)/ x_raw(for cols)
-                        for each member, used to differenciate classes
-            type:       str("row"/"col") based on finding order of rows/columns
+        labels, n_classes = cluster_1d(detection_column(self.detected, axis), self.but[axis]/2)
+        classes = classes_from_labels(labels, n_classes)
+        if axis == 1:
+            self.row_labels, self.rows = labels, classes
+        else:
+            self.col_labels, self.cols = labels, classes
+        return labels, classes
 
-        Returns:
-            out:        Returns the ordered list of rows/cols
-    
-        Raises:
-            TypeError:  When arg type is not either "col" or "row"
-        """
-        rearranged, out = [], []
-        indexing = np.argsort(comp_hist)
+def detection_column(detected, index):
+    """Returns the index-th field of every detection as a float array."""
+    detected = np.asarray(detected)
+    if detected.dtype.names is not None:
+        return detected[detected.dtype.names[index]].astype(float)
+    return detected[:, index].astype(float)
 
-        for j in indexing:
-            rearranged.append(coord[j])
-        _, idx = np.unique(rearranged, return_index=True)
+def cluster_1d(values, gap):
+    """Groups 1D positions into classes in O(n log n).
 
-        for j in np.sort(idx):
-            out.append(rearranged[j])
+    The values are sorted once and a new class starts wherever two sorted
+    neighbours are at least gap apart (single linkage along the axis).
 
-        if type == "col":
-            self.cols = out
-        elif type == "row":
-            self.rows = out
-        else:
-            raise TypeError("Type must be a (row) or (col)")
-        
-        return out
+    Returns:
+        labels:         Numpy array of the class of every value, classes numbered by position
+        n_classes:      Number of classes
+    """
+    values = np.asarray(values, dtype=float)
+    if not len(values):
+        return np.empty(0, dtype=np.intp), 0
+    order = np.argsort(values, kind="stable")
+    breaks = np.diff(values[order]) >= gap
+    labels = np.empty(len(values), dtype=np.intp)
+    labels[order] = np.concatenate(([0], np.cumsum(breaks)))
+    return labels, int(breaks.sum()) + 1
+
+def classes_from_labels(labels, n_classes):
+    """Returns a list of lists of member indices for every class, members in ascending order."""
+    order = np.argsort(labels, kind="stable")
+    counts = np.bincount(labels, minlength=n_classes)
+    return [members.tolist() for members in np.split(order, np.cumsum(counts)[:-1])]
 
 class Template:
     """A class for assigning a template to detection instance.
@@ -186,18 +167,22 @@ class Template:
         n_ranks:                    List of ranked template candidates
         priority_lr:                Boolean of left-right sequence priority
         priority_vh:                Boolean of horizontal-vertical sequence priority
+        serpentine:                 Boolean of boustrophedon counting (every other row/column backwards)
+        orders:                     List of index permutations, one per ranked candidate
         rows:                       List of ordered unique cols inherited from panel instance
         cols:                       List of ordered unique rows inherited from panel instance
         seq:                        Sequence of raw button numbers
+        seq_index:                  Button index of every member of seq
+        diagnostics:                TemplateDiagnostics of the last run (ranks, layout, corrections)
         jump_button:                Boolean of jumpButton presence
         softmax_pred:               A list of lists of x',x'',x''' prediction of label of buttons from given data
     
     Methods:
         find_template_candidate:    Finds ranks of all possible templates and saves them in a list
-        assign_template:            Sets priority_XX based on best template candidate, prints info
-        count_lr:                   Creates an iterable list through which it computes left-right ranks
-        count_vh:                   Creates an iterable list through which it computes horizontal-vertical ranks
-        suppress_odd_rows:          Based on average members in row suppresses first row, prints info if it did
+        build_orders:               Builds the index permutations of all candidates once
+        layout_order:               Builds the index permutation of one layout and direction
+        assign_template:            Sets priority_XX based on best template candidate
+        suppress_odd_rows:          Based on average members in row suppresses first row
         recalculate_cols:           Recalculates the columns based upon the suppressed rows
         flatten_sqq:                Flattens number sequence (suppreses odd rows for priority_vh = False)
         find_seq_error              Finds errors in numbering buttons
@@ -208,7 +193,10 @@ class Template:
         self.n_ranks = None
         self.priority_lr = None #True if left->right, false if right->left
         self.priority_vh = None #True if counting by rows, false if counting by columns
+        self.serpentine = False #True if every other row/column is counted backwards
         self.seq = None
+        self.seq_index = None
+        self.diagnostics = TemplateDiagnostics()
         self.jump_button = False
         
         self.buttons_raw = buttons_raw
@@ -224,128 +212,73 @@ class Template:
         self.order_buttons()
     
     def find_template_candidate(self):
-        """Ranks the numbering template based upon its correct probability."""
-        self.rank_h_lr = self.count_lr("left")
-        self.rank_h_rl = self.count_lr("right")
-        self.rank_v_lr = self.count_vh("left")
-        self.rank_v_rl = self.count_vh("right")
-        
-        self.n_ranks = [self.rank_h_lr, self.rank_h_rl, self.rank_v_lr, self.rank_v_rl]
-        print(self.n_ranks)
-
-    def assign_template(self):
-        """Assigns priority_XX to Template object.
+        """Ranks the numbering template based upon its correct probability.
 
-        Raises:
-            ValueError:  Unexpected input
+        All layouts are ranked in one pass, in the order of LAYOUTS, each
+        counted from the left and from the right:
+        [h_lr, h_rl, v_lr, v_rl, hs_lr, hs_rl, vs_lr, vs_rl]
+        Every candidate is scored on the exact order flatten_seq reads it in.
         """
-        minElement = np.argmax(np.array(self.n_ranks)) #gets the index of the best candidate
+        self.build_orders()
+        ranks = rank_orders(self.buttons_raw['n_raw'], self.orders).reshape(-1, 2)
+        self.rank_h_lr, self.rank_h_rl = ranks[0]
+        self.rank_v_lr, self.rank_v_rl = ranks[1]
 
-        if minElement == 0 or minElement == 2:
-            self.priority_lr = True
-        elif minElement == 1 or minElement == 3:
-            self.priority_lr = False
-        else:
-            raise ValueError("Unexpected input into finding template")
+        self.n_ranks = ranks.ravel().tolist()
+        self.diagnostics.ranks = self.n_ranks
+        logger.debug("Template ranks %s", self.n_ranks)
 
-        if minElement == 0 or minElement == 1:
-            self.priority_vh = True
-        elif minElement == 2 or minElement == 3:
-            self.priority_vh = False
-        else:
-            raise ValueError("Unexpected input into finding template")
+    def build_orders(self):
+        """Builds the index permutations of all candidates once.
 
-        print(f'The values are ordered from left to right: {self.priority_lr} \nThe values are counted by rows: {self.priority_vh}')
+        Rows and serpentine rows run through all rows; columns and serpentine
+        columns are recalculated from the rows without the suppressed one.
+        Every layout of LAYOUTS is built left to right, then right to left.
+        """
+        rows_suppressed, self.del_index = self.suppress_odd_rows()
+        self.cols_suppressed = self.recalculate_cols(rows_suppressed)
+        self.orders = [self.layout_order(layout in ("rows", "rows_serpentine"), priority_lr,
+                                         layout in ("rows_serpentine", "cols_serpentine"))
+                       for layout in LAYOUTS for priority_lr in (True, False)]
+        return self.orders
+
+    def layout_order(self, priority_vh, priority_lr, serpentine):
+        """Builds the index permutation of a panel read in one layout and direction.
+
+        For right to left, the members of each row are reversed (counting by
+        rows) or the columns are taken from the right (counting by columns).
+        Serpentine then reverses every other of these rows/columns.
+        """
+        if priority_vh:
+            groups = self.rows if priority_lr else [row[::-1] for row in self.rows]
+        else:
+            groups = self.cols_suppressed if priority_lr else self.cols_suppressed[::-1]
+        return flatten_groups(groups, serpentine)
 
-    def count_lr(self, order):
-        """Creates an iterable list through rows and computes left-right ranks.
+    def assign_template(self):
+        """Assigns priority_XX and serpentine to Template object.
 
-        Args:
-            order:          str("left"/"right"), test counting from left/right
+        On equal ranks the first candidate wins, so the plain layouts take
+        precedence over the serpentine ones.
 
-        Returns:
-            n_order:        Rank of the tested sequence
-    
         Raises:
-            ValueError:     arg(order): Order must be either left or right
+            ValueError:  Unexpected input
         """
-        if order == "left":
-            axis = 1
-        elif order == "right":
-            axis = -1
-        else:
-            raise ValueError("Order must be either left or right")
+        minElement = int(np.argmax(np.array(self.n_ranks))) #gets the index of the best candidate
+        if not 0 <= minElement < 2*len(LAYOUTS):
+            raise ValueError("Unexpected input into finding template")
 
-        #Making an iterable list to count with
-        listed_numbers = []
-        for row in self.rows:
-            for i in row:
-                listed_numbers.append(self.buttons_raw[i].n_raw) #get the proposed button number
-        
-        #Defining starting positions
-        if axis == 1:
-            curr, foll = 0, 0
-        if axis == -1:
-            curr, foll = -1, -1
-        n_order = 0
-        #Iterate through the list
-        for _ in range(len(listed_numbers)-1):
-            foll += axis
-
-            if listed_numbers[curr] < listed_numbers[foll]:
-                n_order += 1
-            else:
-                n_order += 0
-            
-            curr = foll
+        layout = LAYOUTS[minElement // 2]
+        self.priority_lr = minElement % 2 == 0
+        self.priority_vh = layout in ("rows", "rows_serpentine")
+        self.serpentine = layout in ("rows_serpentine", "cols_serpentine")
 
-        return n_order #Return order of the sequence
-    
-    def count_vh(self, order):
-        """Creates an iterable list through columns and computes horizontal-vertical ranks.
+        self.diagnostics.layout = layout
+        self.diagnostics.priority_lr = self.priority_lr
+        self.diagnostics.priority_vh = self.priority_vh
+        self.diagnostics.serpentine = self.serpentine
+        logger.debug("Template %s, left to right: %s", layout, self.priority_lr)
 
-        Args:
-            order:          str("left"/"right"), test counting from left/right
-
-        Returns:
-            n_order:        Rank of the tested sequence
-    
-        Raises:
-            ValueError:     arg(order): Order must be either left or right
-        """
-        if order == "left":
-            axis = 1
-        elif order == "right":
-            axis = -1
-        else:
-            raise ValueError("Order must be either left or right")
-        #Suppression and recalculation of odd data
-        rows_suppressed,___ = self.suppress_odd_rows()
-        cols_suppressed = self.recalculate_cols(rows_suppressed)
-        #Making an iterable list to count with
-        listed_numbers = []
-
-        for col in cols_suppressed:
-            for i in col:
-                listed_numbers.append(self.buttons_raw[i].n_raw) #get the proposed button number
-
-        #Defining starting positions
-        if axis == 1:
-            curr, foll = 0, 0
-        if axis == -1:
-            curr, foll = -1,-1
-        n_order = 0
-        #Iterate through the list
-        for _ in range(len(listed_numbers)-1):
-            foll += axis
-            if listed_numbers[curr] < listed_numbers[foll]:
-                n_order += 1
-            else:
-                n_order += 0
-            curr = foll
-        
-        return n_order #Return order of the sequence
-    
     def suppress_odd_rows(self):
         """Suppresses first row of panel for counting rank if the row is smaller than avg of all others.
 
@@ -362,9 +295,11 @@ class Template:
 
         if avg_in_row > len(self.rows[0]): #compare if the first row has less members
             del_index = self.rows[0][:]
-            suppressed_rows = np.delete(self.rows, del_index)
-            print("First row suppressed for rank count")
+            suppressed_rows = self.rows[1:]
+            self.diagnostics.suppressed_row = del_index
+            logger.debug("First row suppressed for rank count")
         else:
+            del_index = []
             suppressed_rows = self.rows
 
         return suppressed_rows, del_index
@@ -395,57 +330,13 @@ class Template:
         return cols_ordered_suppressed
 
     def flatten_seq(self):
-        """Creates an iterable list based on assigned template."""
-        seq = []
-        if self.priority_vh == True:
-            if self.priority_lr == True:
-                rows_private = self.rows
-            
-            elif self.priority_lr == False:
-                rows_private = []
-                for row in self.rows:
-                    rows_private_row = []
-                    flip = -1
-                    for _ in range(len(row)):
-                        rows_private_row.append(row[flip])
-                        flip -=1
-                    rows_private.append(rows_private_row)
-            else:
-                raise ValueError("Priorities have to be boolean")
-                    
-            for row in rows_private:
-                curr = 0
-                for _ in row:
-                    seq.append(self.buttons_raw[row[curr]].n_raw)
-                    curr += 1
-            
-            del_index = []
-                    
-        elif self.priority_vh == False:
-            rows_suppressed, del_index = self.suppress_odd_rows()
-            cols_suppressed = self.recalculate_cols(rows_suppressed)
-
-            if self.priority_lr == True:
-                cols_private = cols_suppressed
-            
-            elif self.priority_lr == False:
-                cols_private = []
-                flip = -1
-                for __ in cols_suppressed:
-                    cols_private.append(cols_suppressed[flip])
-                    flip -= 1
-            else:
-                raise ValueError("Priorities have to be boolean")
-
-            for col in cols_private:
-                curr = 0
-                for _ in col:
-                    seq.append(self.buttons_raw[col[curr]].n_raw)
-                    curr += 1
-        else:
-                raise ValueError("Priorities have to be boolean")
+        """Creates an iterable list based on assigned template, see layout_order."""
+        if not isinstance(self.priority_vh, bool) or not isinstance(self.priority_lr, bool):
+            raise ValueError("Priorities have to be boolean")
+        self.seq_index = self.layout_order(self.priority_vh, self.priority_lr, self.serpentine)
+        seq = self.buttons_raw['n_raw'][self.seq_index].tolist()
         self.seq = seq
-        self.del_flatten_index = del_index
+        self.del_flatten_index = [] if self.priority_vh else self.del_index
         return seq
 
     def find_seq_error(self):
@@ -486,7 +377,8 @@ class Template:
 
                 while found_valid_number == False:
                     if valid_number_index >= len(seq_correct):
-                        print("loop broken")
+                        self.diagnostics.unresolved.append(seq_index)
+                        logger.debug("No valid number after index(%d)", seq_index)
                         valid_number_index = valid_number_index-1
                         break
                     if seq_correct[valid_number_index] == True:
@@ -496,15 +388,18 @@ class Template:
 
                 if (abs(seq[seq_index-1]-seq[valid_number_index])) == (abs(valid_number_index-(seq_index-1))):
                     for i in range(seq_index, valid_number_index):
+                        old = seq[i]
                         seq[i] = seq[seq_index-1]+(seq_index-i)+1
                         seq_numbers_corrected.append(seq[i])
                         seq_index_corrected.append(i)
                         seq_correct[seq_index] = True
-                        print(f'Replaced index({i}) with number({seq[i]})')
+                        self.diagnostics.corrections.append((i, old, seq[i]))
+                        logger.debug("Replaced index(%d) with number(%s)", i, seq[i])
                 
                 elif (abs(seq[seq_index-1]-seq[valid_number_index])) != (abs(valid_number_index-(seq_index-1))):
-                    print("Jump button detected.")
                     self.jump_button = True
+                    self.diagnostics.jump_buttons.append(seq_index)
+                    logger.debug("Jump button detected at index(%d)", seq_index)
                     pred = self.softmax_pred
                     for proposal in range(3):
                         if pred[seq_index][proposal] == seq[valid_number_index]+(seq_index - valid_number_index) or pred[seq_index][proposal] == seq[seq_index]-((seq_index-1)-seq_index):
@@ -512,66 +407,147 @@ class Template:
                         else:
                             proposal_rank = 0
                         if proposal_rank == 1:
+                            old = seq[i]
                             seq[i] = pred[seq_index][proposal]
-                            print(f'Replaced index({i}) with number({seq[i]})')
+                            self.diagnostics.corrections.append((i, old, seq[i]))
+                            logger.debug("Replaced index(%d) with number(%s)", i, seq[i])
                             break
 
                     #TODO:not tested
         self.seq = seq
-        print(f'Button labels  {self.seq_old} \nfixed to array {np.array(self.seq)}')
+        logger.debug("Button labels %s fixed to %s", self.seq_old, seq)
 
     def order_buttons(self):
-        """Grants buttons their columns and rows ad proper number"""
-        button_list = self.buttons_raw
-        j = 0
-        for i in self.buttons_raw:
-            i.n_valid = self.seq_correct_old[j]
-            i.n_correct = self.seq[j]
-            j +=1
-        
-        row_index = 0
-        for row in self.rows:
-            row_index +=1
-            for item in row:
-                button_list[item].row = row_index
-        
-        col_index = 0
-        for col in self.cols:
-            col_index +=1
-            for item in col:
-                button_list[item].col = col_index
-        
-        self.buttons = button_list
-        for but in self.buttons:
-            print(but.__dict__)
+        """Grants buttons their columns and rows ad proper number, whole columns at once."""
+        button_table = self.buttons_raw
+        button_table['n_valid'][self.seq_index] = self.seq_correct_old
+        button_table['n_correct'][self.seq_index] = self.seq
+        assign_positions(button_table, self.rows, self.cols)
+        self.buttons = button_table
+        if logger.isEnabledFor(logging.DEBUG):
+            for but in self.buttons:
+                logger.debug("Button %s", but)
+
+class TemplateDiagnostics:
+    """What a Template decided, for inspection without console output.
+
+    Set logging to DEBUG for the same information as log messages.
+
+    Attributes:
+        ranks:                  List of ranks of all template candidates
+        layout:                 Chosen layout, one of LAYOUTS
+        priority_lr:            Boolean of left-right sequence priority
+        priority_vh:            Boolean of horizontal-vertical sequence priority
+        serpentine:             Boolean of boustrophedon counting
+        suppressed_row:         Button indices of the row suppressed for ranking, empty if none
+        corrections:            List of (sequence index, old number, new number)
+        jump_buttons:           Sequence indices where a jump button was detected
+        unresolved:             Sequence indices with no valid number after them
+    """
+    __slots__ = ("ranks", "layout", "priority_lr", "priority_vh", "serpentine",
+                 "suppressed_row", "corrections", "jump_buttons", "unresolved")
+
+    def __init__(self):
+        """Initializes empty diagnostics."""
+        self.ranks = None
+        self.layout = None
+        self.priority_lr = None
+        self.priority_vh = None
+        self.serpentine = None
+        self.suppressed_row = []
+        self.corrections = []
+        self.jump_buttons = []
+        self.unresolved = []
+
+#Layouts a panel can be numbered in, ranked in this order
+LAYOUTS = ("rows", "cols", "rows_serpentine", "cols_serpentine")
+
+def flatten_groups(groups, serpentine=False):
+    """Concatenates rows/columns of button indices, reversing every other one when serpentine."""
+    if serpentine:
+        groups = [group if k % 2 == 0 else group[::-1] for k, group in enumerate(groups)]
+    return np.array([i for group in groups for i in group], dtype=np.intp)
+
+def rank_orders(numbers, orders):
+    """Ranks index orders by how their numbers increase, all orders in one vectorized pass.
+
+    The rank of an order is the number of its increasing neighbour pairs.
+
+    Returns:
+        ranks:          Numpy array (len(orders),) of ranks
+    """
+    lengths = np.array([len(order) for order in orders])
+    padded = np.zeros((len(orders), max(lengths.max(), 1)), dtype=np.intp)
+    for k, order in enumerate(orders):
+        padded[k, :len(order)] = order
+    steps = np.diff(np.asarray(numbers)[padded], axis=1)
+    valid = np.arange(padded.shape[1] - 1) < (lengths - 1)[:, None]
+    return ((steps > 0) & valid).sum(axis=1)
+
+#Columns of a button table, one record per detected button
+BUTTON_DTYPE = np.dtype([('x_raw', np.float64), ('y_raw', np.float64),
+                         ('n_raw', np.int32), ('n_correct', np.int32), ('n_valid', np.bool_),
+                         ('row', np.int16), ('col', np.int16)])
+
+def button_table(x_raw, y_raw, n_raw):
+    """Creates a button table, n_correct starts as n_raw, row/col 0 means not assigned."""
+    table = np.zeros(len(n_raw), dtype=BUTTON_DTYPE)
+    table['x_raw'] = x_raw
+    table['y_raw'] = y_raw
+    table['n_raw'] = n_raw
+    table['n_correct'] = n_raw
+    return table
+
+def assign_positions(table, rows, cols):
+    """Writes the 1-based row/column of every button listed in rows/cols into the table."""
+    for i, row in enumerate(rows):
+        table['row'][row] = i + 1
+    for j, col in enumerate(cols):
+        table['col'][col] = j + 1
+
+def button_field(name):
+    """Returns a property reading and writing one column of the button table."""
+    def get(self):
+        return self.table[name][self.index]
+    def set(self, value):
+        self.table[name][self.index] = value
+    return property(get, set)
 
 class Button:
-    """A storage class for button instance.
+    """A lightweight view of one button of a button table.
+
+    The values live in the table, so creating views is cheap and setting an
+    attribute writes through to the table.
 
     Attributes:
         x_raw:                  X coordinate from button recognition data
         y_raw:                  Y coordinate from button recognition data
         n_raw:                  Proposed number from button recognition data
-        n_miss:                 An attribute indicating whether the button is suspected to be mislabeled
-        col:                    Column coordinate/position
-        row:                    Row coordinate/position
+        n_correct:              Number after the sequence was fixed
+        n_valid:                Boolean, the proposed number fitted the sequence
+        col:                    Column coordinate/position (1-based, 0 if not assigned)
+        row:                    Row coordinate/position (1-based, 0 if not assigned)
     """
-    def __init__(self,x_raw,y_raw,n_raw):
-        """Initializes the class with position parameters."""
-        self.x_raw = x_raw
-        self.y_raw = y_raw
-        self.n_raw = n_raw
-        self.n_correct = None
-        self.n_valid = None
-        
-        self.col = None
-        self.row = None
+    __slots__ = ("table", "index")
+
+    x_raw = button_field('x_raw')
+    y_raw = button_field('y_raw')
+    n_raw = button_field('n_raw')
+    n_correct = button_field('n_correct')
+    n_valid = button_field('n_valid')
+    row = button_field('row')
+    col = button_field('col')
+
+    def __init__(self, table, index):
+        """Initializes the view of the index-th button of table."""
+        self.table = table
+        self.index = index
  
 class Panel:
     """A class for button panel.
 
     Attributes:
-        buttons:                List of Button instances
+        buttons:                Button table (BUTTON_DTYPE structured array)
         rows:                   List of ordered unique rows
         cols:                   List of ordered unique columns
         priority_lr:            Boolean of left-right sequence priority
@@ -579,6 +555,8 @@ class Panel:
     
     Methods:
         assign_buttons:         Assigns coordinates of button objects
+        button:                 Returns a Button view of one button
+        button_views:           Returns Button views of all buttons
         
     """
     def __init__(self,buttons,rows,cols,priority_lr,priority_vh):
@@ -591,19 +569,105 @@ class Panel:
     
     def assign_buttons(self):
         """A method for assigning buttons coords to a detection instance."""
-        i = 0
-        for row in self.rows:
-            i +=1
-            for item in row:
-                self.buttons[item].row = i
-        j = 0
-        for col in self.cols:
-            j +=1
-            for item in col:
-                self.buttons[item].col = j
-
-#Istance of Detection class
-empty_predictions = np.empty((15,3))
-det = Detection(data_OCR,empty_predictions,but_w,but_h)
-#print(det.template.n_ranks,det.template.priority_lr,det.template.priority_vh, det.template.rows, det.template.cols, det.buttons_raw[5].n_raw)
-#print(det.template.seq, det.template.seq_correct)
\ No newline at end of file
+        assign_positions(self.buttons, self.rows, self.cols)
+
+    def button(self, index):
+        """Returns a Button view of the index-th button."""
+        return Button(self.buttons, index)
+
+    def button_views(self):
+        """Returns a list of Button views, for callers wanting per-button objects."""
+        return [Button(self.buttons, i) for i in range(len(self.buttons))]
+
+class PanelResult:
+    """Compact result of postprocessing one panel.
+
+    Attributes:
+        index:                  Position of the panel in the batch
+        n_correct:              Numpy array of the fixed number of every button, in detection order
+        n_valid:                Numpy array of booleans, the raw number fitted the sequence
+        row:                    Numpy array of the 1-based row of every button
+        col:                    Numpy array of the 1-based column of every button
+        priority_lr:            Boolean of left-right sequence priority
+        priority_vh:            Boolean of horizontal-vertical sequence priority
+        serpentine:             Boolean of boustrophedon counting
+        jump_button:            Boolean of jumpButton presence
+        diagnostics:            TemplateDiagnostics of the panel
+        error:                  Error message when the panel could not be processed, else None
+    """
+    __slots__ = ("index", "n_correct", "n_valid", "row", "col", "priority_lr",
+                 "priority_vh", "serpentine", "jump_button", "diagnostics", "error")
+
+    def __init__(self, index, detection=None, error=None):
+        """Takes the columns and template flags out of a Detection, or records the error."""
+        self.index = index
+        self.error = error
+        if detection is None:
+            self.n_correct = self.n_valid = self.row = self.col = None
+            self.priority_lr = self.priority_vh = self.serpentine = self.jump_button = None
+            self.diagnostics = None
+            return
+        buttons = detection.panel.buttons
+        self.n_correct = buttons['n_correct'].copy()
+        self.n_valid = buttons['n_valid'].copy()
+        self.row = buttons['row'].copy()
+        self.col = buttons['col'].copy()
+        template = detection.template
+        self.priority_lr = template.priority_lr
+        self.priority_vh = template.priority_vh
+        self.serpentine = template.serpentine
+        self.jump_button = template.jump_button
+        self.diagnostics = template.diagnostics
+
+def process_panel(task):
+    """Postprocesses one panel of a batch, task is (index, detected, softmax_pred, but_w, but_h).
+
+    Errors of a single panel are returned in its result instead of stopping the batch.
+    """
+    index, detected, softmax_pred, but_w, but_h = task
+    if softmax_pred is None:
+        softmax_pred = np.zeros((len(detected), 3))
+    try:
+        return PanelResult(index, Detection(detected, softmax_pred, but_w, but_h))
+    except (ValueError, IndexError, TypeError, NameError) as error:
+        return PanelResult(index, error=repr(error))
+
+def process_panels(detections, softmax_preds=None, but_w=but_w, but_h=but_h,
+                   processes=None, chunksize=16):
+    """Postprocesses a batch of panels, e.g. the frames of a clip or a labeled dataset.
+
+    Clustering, template assignment and sequence fixing run for every panel
+    in a pool of worker processes; panels are handed out in chunks so the
+    per-task overhead stays small next to the work on a panel.
+
+    Args:
+        detections:             Sequence of detection arrays, one per panel (a 3D stack works too)
+        softmax_preds:          Sequence of softmax predictions per panel, None for empty predictions
+        but_w, but_h:           Button width and height, shared by all panels
+        processes:              Number of worker processes, None for all cores, 1 to run in this process
+        chunksize:              Number of panels sent to a worker at once
+
+    Returns:
+        results:                List of PanelResult, in the order of detections
+    """
+    if softmax_preds is None:
+        softmax_preds = [None]*len(detections)
+    tasks = [(i, detected, pred, but_w, but_h)
+             for i, (detected, pred) in enumerate(zip(detections, softmax_preds))]
+    if processes == 1:
+        return [process_panel(task) for task in tasks]
+    import multiprocessing
+    with multiprocessing.Pool(processes) as pool:
+        return list(pool.imap(process_panel, tasks, chunksize))
+
+def main():
+    logging.basicConfig(level=logging.DEBUG)
+    #Istance of Detection class
+    empty_predictions = np.empty((15,3))
+    det = Detection(data_OCR,empty_predictions,but_w,but_h)
+    #print(det.template.n_ranks,det.template.priority_lr,det.template.priority_vh, det.template.rows, det.template.cols, det.buttons_raw['n_raw'][5])
+    #print(det.template.seq, det.template.seq_correct)
+    return det
+
+if __name__ == "__main__":
+    main()
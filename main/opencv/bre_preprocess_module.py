@@ -15,33 +15,72 @@ from it for further use. The principles used to process the data are:
 Typical usage example:
 TODO:
 """
-from imutils import contours
+import os
+import sys
+import threading
+import time
+
 import imutils
 import cv2
 import matplotlib
 import numpy as np
 
+try:
+    from main.opencv import preprocess
+    from main.opencv.roi_tracker import PanelTracker
+except ImportError:
+    import preprocess
+    from roi_tracker import PanelTracker
+try:
+    from main.common import coms
+except ImportError:
+    #Run as a script from main/opencv, coms lives in a sibling package
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+    from main.common import coms
+
+#Ports the stage images are published on, the dashboard grid subscribes to them
+STAGE_PORTS = {"raw": 5560, "gray": 5561, "edges": 5562, "boxes": 5563}
+
 
 class Video:
     """An object representing the data given.
 
     Attributes:
         id
-        image
-    
+        camera_number
+        VideoFeed:              cv2.VideoCapture object
+        threaded:               Boolean, frames are captured by a background thread
+        ring:                   List of preallocated frame buffers (threaded mode)
+        frame_seq:              Sequence number of the newest captured frame
+        frame_time:             Capture time (time.time()) of the newest frame
+        reserved:               Ring index of the frame last returned by read_latest
+
     Methods:
-        aaa
-        bbb
-    
+        create_video_object:    Creates VideoCapture object
+        read_next_video_frame:  Reads the next frame (newest one in threaded mode)
+        start_capture:          Starts the capture thread
+        read_latest:            Returns the newest frame with its sequence number and timestamp
+        release:                Stops the capture thread and releases the camera
+
     Raises:
-        jeden rejz
-        druhy rejz
+        IOError:                When the camera gives no first frame in threaded mode
+        ValueError:             When ring_size is smaller than 3 in threaded mode
     """
-    def __init__(self, id, camera_number):
+    def __init__(self, id, camera_number, threaded=False, ring_size=3):
         """Initializes the class and calls its methods."""
         self.id = id
         self.camera_number = camera_number
+        self.threaded = threaded
+        self.ring_size = ring_size
+        self.ring = None
+        self.frame_index = None
+        self.frame_seq = 0
+        self.frame_time = None
+        self.returned_seq = 0
+        self.reserved = None
         self.create_video_object()
+        if threaded:
+            self.start_capture()
 
     def create_video_object(self):
         """Creates VideoCapture object."""
@@ -50,33 +89,164 @@ class Video:
 
     def read_next_video_frame(self):
         """Reads a current frame from the camera."""
+        if self.threaded:
+            latest = self.read_latest()
+            if latest is None:
+                print("Problem occured getting next frame")
+                return None
+            return latest[2]
         success, frame = self.VideoFeed.read()
         if success:
             return frame
         else:
             print("Problem occured getting next frame")
 
+    def start_capture(self):
+        """Allocates the frame ring from the first frame and starts the capture thread.
+
+        The thread reads every frame into a buffer of the ring, so no array is
+        allocated per frame and capturing overlaps with processing. It never
+        writes into the newest frame nor into the one last returned by
+        read_latest, which stays untouched until the next read_latest call.
+        """
+        if self.ring_size < 3:
+            raise ValueError("The frame ring needs at least 3 buffers")
+        success, frame = self.VideoFeed.read()
+        if not success:
+            raise IOError("Problem occured getting first frame")
+        self.ring = [np.empty_like(frame) for __ in range(self.ring_size)]
+        self.ring[0][...] = frame
+        self.frame_index = 0
+        self.frame_seq = 1
+        self.frame_time = time.time()
+        self.cond = threading.Condition()
+        self.capturing = True
+        self.capture_thread = threading.Thread(target=self.capture_loop, daemon=True)
+        self.capture_thread.start()
+
+    def capture_loop(self):
+        """Reads frames into the ring until release is called.
+
+        Failed reads are reported once per outage and retried with a
+        backoff doubling from 10 ms up to 1 s.
+        """
+        failures, backoff = 0, 0.01
+        while self.capturing:
+            with self.cond:
+                index = next(i for i in range(self.ring_size)
+                             if i != self.frame_index and i != self.reserved)
+            success, frame = self.VideoFeed.read(image=self.ring[index])
+            if not success:
+                if failures == 0:
+                    print("Problem occured getting next frame, retrying")
+                failures += 1
+                time.sleep(backoff)
+                backoff = min(2*backoff, 1.0)
+                continue
+            if failures:
+                print(f"Camera recovered after {failures} failed reads")
+                failures, backoff = 0, 0.01
+            if frame is not self.ring[index]:
+                # resolution changed, VideoCapture allocated a new buffer
+                self.ring[index] = frame
+            with self.cond:
+                self.frame_index = index
+                self.frame_seq += 1
+                self.frame_time = time.time()
+                self.cond.notify_all()
+
+    def read_latest(self, timeout=1.0):
+        """Returns the newest captured frame.
+
+        Waits (at most timeout seconds) for a frame that was not returned yet.
+        The returned buffer is not overwritten until the next call.
+
+        Returns:
+            frame_seq:          Sequence number of the frame
+            frame_time:         Capture time of the frame
+            frame:              The frame, a buffer of the ring (do not modify it)
+            None if no new frame was captured within timeout
+        """
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.frame_seq > self.returned_seq, timeout):
+                return None
+            self.returned_seq = self.frame_seq
+            self.reserved = self.frame_index
+            return self.frame_seq, self.frame_time, self.ring[self.frame_index]
+
+    def release(self):
+        """Stops the capture thread and releases the camera."""
+        if self.threaded and self.capturing:
+            self.capturing = False
+            self.capture_thread.join()
+        self.VideoFeed.release()
+
     def load_static_image(self):
         pass
 
+class StagePublisher:
+    """Publishes the images of the preprocessing stages to the dashboard.
+
+    Every stage gets a PUB_SUB sender on its own port, so the feeds of the
+    dashboard grid can subscribe to the stages they show.
+
+    Attributes:
+        senders:                Dict of stage name -> coms.ComInst sender
+
+    Methods:
+        publish:                Sends the image of a stage, if it has a port
+        close:                  Closes all senders
+    """
+    def __init__(self, ports=STAGE_PORTS):
+        """Binds one PUB_SUB sender per stage."""
+        self.senders = {name: coms.ComInst(direction='send', port=port, mode='PUB_SUB')
+                        for name, port in ports.items()}
+
+    def publish(self, name, image):
+        """Sends the image of stage name, stages without a port are skipped."""
+        sender = self.senders.get(name)
+        if sender is not None and image is not None:
+            sender.instance.send_image(name, image)
+
+    def close(self):
+        """Closes all senders."""
+        for sender in self.senders.values():
+            sender.close()
+        self.senders = {}
+
 class Preprocess:
     """An object representing the the preprocessing algorithm.
 
     Attributes:
-        xxx
-        yyy
-    
+        debug:                  Boolean, render and show the labelled debug images, off by default
+        publisher:              StagePublisher sending the stage images, None when not publishing
+        tracker:                PanelTracker running the stages only around the panel, None when
+                                every frame is searched fully
+        cnts:                   List of the contours of the last frame, in found order
+        cnts_sorted:            List of the same contours, ordered bottom to top
+        boxes:                  (N,4,2) array of the rotated boxes of the contours
+
     Methods:
         measure_perf:
-        bbb
+        candidate_extraction:   Finds the contours once and sorts them
+        size_filter:            Turns the contours into rotated boxes
+        detect:                 Runs the stages on a frame or a ROI of it, returns its boxes
     
     Raises:
         jeden rejz
         druhy rejz
     """
-    def __init__(self, id, video_instance):
-        """Initializes the class and calls its methods."""
+    def __init__(self, id, video_instance, debug=False, publish=False, track=False):
+        """Initializes the class and calls its methods.
+
+        With track, the stages run only on a padded ROI around the panel once
+        it was found; the full frame is searched again periodically and as
+        soon as the ROI loses too many boxes (see roi_tracker.PanelTracker).
+        """
         self.id = id
+        self.debug = debug
+        self.publisher = StagePublisher() if publish else None
+        self.tracker = PanelTracker(self.detect) if track else None
         self.tick_init = cv2.getTickCount()
         self.video_instance = video_instance
         self.image_raw = video_instance.read_next_video_frame()
@@ -84,6 +254,11 @@ class Preprocess:
         self.ROI_panel = None
         self.ROI_buttons = None
         self.sorted_label = None
+        self.orig_label = None
+        self.clone = None
+        self.cnts = []
+        self.cnts_sorted = []
+        self.boxes = None
     
     def measure_perf(self, start, end, name='Script'):
         """Measures performance of a piece of code.
@@ -124,35 +299,66 @@ class Preprocess:
         return self.edges
 
     def candidate_extraction(self):
-        self.cnts = cv2.findContours(self.edges, mode = cv2.RETR_EXTERNAL, method = cv2.CHAIN_APPROX_SIMPLE)
-        cnts = cv2.findContours(self.edges, mode = cv2.RETR_EXTERNAL, method = cv2.CHAIN_APPROX_SIMPLE)
-        cnts = imutils.grab_contours(cnts)
-        for (i, c) in enumerate(cnts):
-            self.orig_label = contours.label_contour(self.image, c, i, color= [240, 0, 159])
-        (cnts, boundingBoxes) = contours.sort_contours(cnts, method = "bottom-to-top")
-        self.clone = self.image.copy()
-        for (i, c) in enumerate(cnts):
-            self.sorted_label = contours.label_contour(self.clone, c, i, color= [240, 0, 159])
+        """Finds the contours once and sorts them, labels them only in debug mode."""
+        self.cnts = preprocess.find_contours(self.edges)
+        self.cnts_sorted, __ = preprocess.sort_contours(self.cnts, method = "bottom-to-top")
+        if self.debug:
+            self.clone = self.image.copy()
+            self.orig_label = preprocess.label_contours(self.image, self.cnts, color= [240, 0, 159])
+            self.sorted_label = preprocess.label_contours(self.clone, self.cnts_sorted, color= [240, 0, 159])
+        return self.cnts_sorted
 
     def size_filter(self):
-        for (i, c) in enumerate(self.cnts[1]):
-            rect = cv2.minAreaRect(c)
-            box = cv2.boxPoints(rect)
-            box = np.int0(box)
-            self.image = cv2.drawContours(self.image,[box],0,(0,0,255),2)
+        """Turns the contours into rotated boxes, draws them only in debug mode."""
+        self.boxes, __ = preprocess.contours_to_boxes(self.cnts)
+        if self.debug:
+            self.image = preprocess.draw_boxes(self.image, self.boxes, (0, 0, 255), 2)
         return self.image
 
     def export(self):
         pass
     
     def show(self, name, frame = False):
-        cv2.imshow(name,frame)
+        """Shows a frame, only in debug mode so headless runs skip the rendering."""
+        if self.debug:
+            cv2.imshow(name,frame)
+
+    def publish(self, name, frame):
+        """Sends a stage image to the dashboard feeds, if publishing."""
+        if self.publisher is not None:
+            self.publisher.publish(name, frame)
 
     def cleanup(self):
         """Cleanup used resources."""
         print("Cleaning up resources.")
-        self.video_instance.VideoFeed.release()
-        cv2.destroyAllWindows()
+        if self.publisher is not None:
+            self.publisher.close()
+        self.video_instance.release()
+        if self.debug:
+            cv2.destroyAllWindows()
+
+    def detect(self, frame):
+        """Runs the stages on a frame, or a ROI of it, and returns its boxes."""
+        self.image = frame
+        self.adjust_brightness_dynamic()
+        self.show("adj_brt", self.image)
+        self.grayscale()
+        self.show("gray", self.image)
+        self.publish("gray", self.image)
+        self.median_filter(kernelsize = 3)
+        self.show("median", self.image)
+        self.canny_edge_extraction(sigma = 0.33)
+        self.show("edges", self.edges)
+        self.publish("edges", self.edges)
+        self.candidate_extraction()
+        self.show("cnts", self.orig_label)
+        if not self.clone is None:
+            self.show("drawed", self.clone)
+        if not self.sorted_label is None:
+            self.show("cnts_sorted", self.sorted_label)
+        self.size_filter()
+        self.show("rectangles", self.image)
+        return self.boxes
 
     def run(self):
         """A method made to be looped indefinitely."""
@@ -163,35 +369,36 @@ class Preprocess:
         else:
             while True:
                 start = cv2.getTickCount()
-                self.image = self.video_instance.read_next_video_frame()
-                self.show("raw", self.image)
-                self.adjust_brightness_dynamic()
-                self.show("adj_brt", self.image)
-                self.grayscale()
-                self.show("gray", self.image)
-                self.median_filter(kernelsize = 3)
-                self.show("median", self.image)
-                self.canny_edge_extraction(sigma = 0.33)
-                self.show("edges", self.edges)
-                self.candidate_extraction()
-                self.show("cnts", self.orig_label)
-                if not self.clone is None:
-                    self.show("drawed", self.clone)
-                if not self.sorted_label is None:
-                    self.show("cnts_sorted", self.sorted_label)
-                self.size_filter()
-                self.show("rectangles", self.image)
+                raw = self.video_instance.read_next_video_frame()
+                if raw is None:
+                    continue
+                self.show("raw", raw)
+                self.publish("raw", raw)
+                if self.tracker is not None:
+                    self.boxes = self.tracker.process(raw)
+                else:
+                    self.detect(raw)
+                if self.publisher is not None:
+                    self.publish("boxes", preprocess.draw_boxes(raw.copy(), self.boxes, (0, 0, 255), 2))
                 end = cv2.getTickCount()
                 #self.measure_perf(start,end)
-                if cv2.waitKey(1) & 0xFF == ord("q"):
+                #Without debug windows there are no key events, stop with Ctrl+C
+                if self.debug and cv2.waitKey(1) & 0xFF == ord("q"):
                     break
         finally:
             self.cleanup()
 
 def main():
-    cap = Video(id = 1, camera_number = 0)
-    loop = Preprocess(id = 1, video_instance = cap)
-    loop.run()
+    cap = Video(id = 1, camera_number = 0, threaded = True)
+    #"debug" shows the labelled stage images, quit them with q,
+    #"publish" feeds the stages to the dashboard grid ('dashboard.py grid'),
+    #"track" searches only around the panel once it was found
+    loop = Preprocess(id = 1, video_instance = cap, debug = "debug" in sys.argv[1:],
+                      publish = "publish" in sys.argv[1:], track = "track" in sys.argv[1:])
+    try:
+        loop.run()
+    except KeyboardInterrupt:
+        pass
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,141 @@
+"""A declarative preprocessing pipeline for button recognition.
+
+#Input:         Camera frames
+#Output:        Last image of the chain, edges, contours, boxes and per-stage timings
+#Assumptions:   Frames of one resolution keep their dtype and channel count
+
+This module chains the functions of preprocess.py from an ordered list of
+stages and their parameters, instead of calling them one by one:
+    image stages write into buffers allocated once per resolution
+    contour stages work on the edges of the last edge stage
+    every stage is timed
+
+Typical usage example:
+
+  pipe = Pipeline([("grayscale", {}),
+                   ("median_filter", {"kernelsize": 3}),
+                   ("canny_edge_extraction", {"sigma": 0.33}),
+                   ("find_contours", {}),
+                   ("box_contours", {}),
+                   ("boxdimension_filter", {"ratio_wh_lim": (0.5, 2.0)})])
+  result = pipe.run(frame)
+  boxes, timings = result["boxes"], pipe.timings
+"""
+from collections import OrderedDict
+
+import cv2
+
+try:
+    from main.opencv import preprocess
+except ImportError:
+    import preprocess
+
+#Stages taking an image and a dst buffer, returning the new image
+IMAGE_STAGES = {
+    "adjust_brightness_dynamic": preprocess.adjust_brightness_dynamic,
+    "grayscale": preprocess.grayscale,
+    "median_filter": preprocess.median_filter,
+    "canny_edge_extraction": preprocess.canny_edge_extraction,
+}
+#Stages producing or filtering contours/boxes, they allocate their own lists
+CONTOUR_STAGES = ("find_contours", "box_contours", "boxdimension_filter")
+
+
+class Pipeline:
+    """An ordered chain of preprocess.py stages with reused buffers.
+
+    Attributes:
+        stages:                 List of (name, parameters) tuples
+        buffers:                Dict of {stage index: output buffer} keyed by input shape,
+                                only the max_resolutions most recently used shapes are kept
+        timings:                Dict of stage name and the time (in seconds) of its last run
+
+    Methods:
+        validate_stages:        Checks that all stages are known
+        run:                    Runs all stages on a frame
+        run_stage:              Runs one stage on the state of the pipeline
+        report:                 Returns a one line summary of the timings
+
+    Raises:
+        ValueError:             When an unknown stage is given
+    """
+
+    def __init__(self, stages, max_resolutions=4):
+        """Initializes the pipeline and validates its stages."""
+        self.stages = [(name, dict(params)) for name, params in stages]
+        self.max_resolutions = max_resolutions
+        self.buffers = OrderedDict()
+        self.timings = {}
+        self.validate_stages()
+
+    def validate_stages(self):
+        """Checks that all stages are known."""
+        for name, __ in self.stages:
+            if name not in IMAGE_STAGES and name not in CONTOUR_STAGES:
+                raise ValueError(f"Unknown stage {name}")
+
+    def run(self, frame):
+        """Runs all stages on a frame.
+
+        Buffers are looked up by the frame shape, so the first frame of each
+        resolution allocates them and all following frames reuse them.
+
+        Returns:
+            state:      Dict with the last "image", "edges", "contours" and "boxes"
+        """
+        state = {"image": frame, "edges": None, "contours": None, "boxes": None}
+        buffers = self.buffers.setdefault(frame.shape, {})
+        self.buffers.move_to_end(frame.shape)
+        if len(self.buffers) > self.max_resolutions:
+            self.buffers.popitem(last=False)
+        for index, (name, params) in enumerate(self.stages):
+            start = cv2.getTickCount()
+            self.run_stage(index, name, params, state, buffers)
+            self.timings[name] = (cv2.getTickCount() - start)/cv2.getTickFrequency()
+        return state
+
+    def run_stage(self, index, name, params, state, buffers):
+        """Runs one stage and updates the state in place."""
+        if name in IMAGE_STAGES:
+            out = IMAGE_STAGES[name](state["image"], dst=buffers.get(index), **params)
+            buffers[index] = out
+            state["image"] = out
+            if name == "canny_edge_extraction":
+                state["edges"] = out
+        elif name == "find_contours":
+            edges = state["image"] if state["edges"] is None else state["edges"]
+            state["contours"] = preprocess.find_contours(edges)
+        elif name == "box_contours":
+            __, state["boxes"] = preprocess.box_contours(None, state["contours"], draw=False, **params)
+        elif name == "boxdimension_filter":
+            __, state["boxes"] = preprocess.boxdimension_filter(None, state["boxes"], draw=False, **params)
+
+    def report(self):
+        """Returns a one line summary of the timings of the last run."""
+        total = sum(self.timings.values())
+        stages = ", ".join(f"{name} {time*1000:.2f}ms" for name, time in self.timings.items())
+        return f"{stages} | total {total*1000:.2f}ms"
+
+
+def main():
+    import bre_preprocess_module as bre_preprocess
+    cap = bre_preprocess.Video(id = 1, camera_number = 0, threaded = True)
+    pipe = Pipeline([("grayscale", {}),
+                     ("median_filter", {"kernelsize": 3}),
+                     ("canny_edge_extraction", {"sigma": 0.33}),
+                     ("find_contours", {}),
+                     ("box_contours", {}),
+                     ("boxdimension_filter", {})])
+    try:
+        while True:
+            result = pipe.run(cap.read_next_video_frame())
+            print(f'{len(result["boxes"])} boxes | {pipe.report()}')
+            cv2.imshow("edges", result["edges"])
+            if cv2.waitKey(1) & 0xFF == ord("q"):
+                break
+    finally:
+        cap.release()
+        cv2.destroyAllWindows()
+
+if __name__ == "__main__":
+    main()
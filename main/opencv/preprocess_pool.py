@@ -0,0 +1,272 @@
+"""A multi-process preprocessing pool for button recognition.
+
+#Input:         Camera frames, possibly from several cameras
+#Output:        Candidate boxes of every frame, in capture order
+#Assumptions:   All frames submitted to one pool have the same size and dtype
+
+This module spreads whole frames over worker processes:
+    frames are copied once into shared memory slots, only slot indices are queued
+    every worker runs the preprocess_pipeline chain
+    grayscale -> median -> canny -> contours -> box filter
+    results are reassembled in capture order
+
+A frame keeps its slot until its result is next in capture order, so the
+number of slots is also the reorder window: it bounds how far ahead of the
+oldest unfinished frame the workers may run and how many results wait to be
+put in order. A stalled frame stops the submission of new ones instead of
+letting finished results pile up behind it.
+
+Typical usage example:
+
+  pool = PreprocessPool(workers=4, window=8)
+  for frame in frames:
+      for seq, boxes, timings in pool.submit(frame):
+          use(boxes)
+  for seq, boxes, timings in pool.close():
+      use(boxes)
+"""
+import collections
+import multiprocessing
+import os
+import queue
+from multiprocessing import shared_memory
+
+import numpy as np
+
+try:
+    from main.opencv.preprocess_pipeline import Pipeline
+except ImportError:
+    from preprocess_pipeline import Pipeline
+
+DEFAULT_STAGES = [("grayscale", {}),
+                  ("median_filter", {"kernelsize": 3}),
+                  ("canny_edge_extraction", {"sigma": 0.33}),
+                  ("find_contours", {}),
+                  ("box_contours", {}),
+                  ("boxdimension_filter", {})]
+
+
+def worker_loop(tasks, results, slot_names, stages):
+    """Processes frames from the task queue until it receives None.
+
+    Workers share the resource tracker of the pool, so attaching to the slots
+    does not take ownership of them; the pool unlinks them on close.
+    """
+    blocks = [shared_memory.SharedMemory(name=name) for name in slot_names]
+    pipe = Pipeline(stages)
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        seq, slot, shape, dtype = task
+        frame = np.ndarray(shape, dtype=dtype, buffer=blocks[slot].buf)
+        try:
+            state = pipe.run(frame)
+            boxes = np.array(state["boxes"], dtype=np.intp).reshape(-1, 4, 2)
+            results.put((seq, slot, boxes, dict(pipe.timings), None))
+        except Exception as error:
+            results.put((seq, slot, None, None, repr(error)))
+        del frame
+    for block in blocks:
+        block.close()
+
+
+class PreprocessPool:
+    """A pool of worker processes preprocessing whole frames.
+
+    Attributes:
+        workers:                Number of worker processes
+        window:                 Number of shared memory slots = reorder window
+        stages:                 Pipeline stages run by every worker
+        next_seq:               Sequence number of the next submitted frame
+        emit_seq:               Sequence number of the next result to be put in order
+        reorder:                Dict of seq -> (slot, result) of results waiting for older frames
+        done:                   Deque of results in capture order, not returned yet
+
+    Methods:
+        start:                  Allocates the slots and starts the workers
+        submit:                 Queues a frame, returns results that are ready
+        collect:                Receives finished results from the workers
+        advance:                Puts the results next in order into done and frees their slots
+        wait:                   Blocks until a result arrives, fails when no worker is left
+        ready:                  Returns the results that are next in capture order
+        close:                  Waits for all frames and stops the workers
+
+    Raises:
+        ValueError:             When a stage is unknown or a frame does not fit the slots
+        RuntimeError:           When a worker failed to process a frame, in capture order
+    """
+
+    def __init__(self, workers=None, window=None, stages=DEFAULT_STAGES):
+        """Initializes the pool, slots and workers are created with the first frame."""
+        self.workers = workers or os.cpu_count()
+        self.window = window or 2*self.workers
+        self.stages = stages
+        Pipeline(stages)
+        self.blocks = None
+        self.processes = []
+        self.next_seq = 0
+        self.emit_seq = 0
+        self.reorder = {}
+        self.done = collections.deque()
+
+    def start(self, frame):
+        """Allocates the slots for frames like this one and starts the workers."""
+        self.shape, self.dtype = frame.shape, frame.dtype.str
+        self.blocks = [shared_memory.SharedMemory(create=True, size=frame.nbytes)
+                       for __ in range(self.window)]
+        self.free_slots = list(range(self.window))
+        context = multiprocessing.get_context()
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+        slot_names = [block.name for block in self.blocks]
+        for __ in range(self.workers):
+            process = context.Process(target=worker_loop, daemon=True,
+                                      args=(self.tasks, self.results, slot_names, self.stages))
+            process.start()
+            self.processes.append(process)
+
+    def submit(self, frame):
+        """Copies the frame into a free slot and queues it.
+
+        Waits for results only when all slots are taken, i.e. when the window
+        of frames not yet put in order is full.
+
+        Returns:
+            ready:      List of (seq, boxes, timings) in capture order
+        """
+        if self.blocks is None:
+            self.start(frame)
+        if frame.shape != self.shape or frame.dtype.str != self.dtype:
+            raise ValueError(f"Frame {frame.shape} {frame.dtype} does not fit slots of {self.shape} {self.dtype}")
+        while not self.free_slots:
+            self.wait()
+            self.advance()
+        slot = self.free_slots.pop()
+        np.ndarray(self.shape, dtype=self.dtype, buffer=self.blocks[slot].buf)[...] = frame
+        self.tasks.put((self.next_seq, slot, self.shape, self.dtype))
+        self.next_seq += 1
+        self.collect(block=False)
+        self.advance()
+        return self.ready()
+
+    def collect(self, block=False, timeout=None):
+        """Moves finished results from the workers into the reorder buffer.
+
+        Results keep their slot until advance. A failed frame is stored as its
+        error message, so the frames after it are still returned and the
+        error is raised in capture order.
+        """
+        while True:
+            try:
+                seq, slot, boxes, timings, error = self.results.get(block=block, timeout=timeout)
+            except queue.Empty:
+                return
+            block = False
+            self.reorder[seq] = (slot, error if error is not None else (seq, boxes, timings))
+
+    def advance(self):
+        """Puts the results that are next in capture order into done and frees their slots."""
+        while self.emit_seq in self.reorder:
+            slot, result = self.reorder.pop(self.emit_seq)
+            self.free_slots.append(slot)
+            self.done.append((self.emit_seq, result))
+            self.emit_seq += 1
+
+    def wait(self, timeout=1.0):
+        """Blocks until a result arrives.
+
+        Raises:
+            RuntimeError:   When all workers have died
+        """
+        while True:
+            waiting = len(self.reorder)
+            self.collect(block=True, timeout=timeout)
+            if len(self.reorder) > waiting:
+                return
+            if not any(process.is_alive() for process in self.processes):
+                raise RuntimeError("All preprocess workers have died")
+
+    def ready(self):
+        """Returns the results that are next in capture order.
+
+        Raises:
+            RuntimeError:   When the next frame failed. The results before it
+                            are returned first, the frames after it by the next call.
+        """
+        out = []
+        while self.done:
+            seq, result = self.done[0]
+            if isinstance(result, str):
+                if out:
+                    break
+                self.done.popleft()
+                raise RuntimeError(f"Frame {seq} failed: {result}")
+            out.append(self.done.popleft()[1])
+        return out
+
+    def close(self, timeout=5.0):
+        """Waits for all queued frames, stops the workers and frees the slots.
+
+        The workers are stopped and the slots unlinked even when a frame failed
+        or all workers died.
+
+        Returns:
+            ready:      List of the remaining (seq, boxes, timings) in capture order
+
+        Raises:
+            RuntimeError:   When any of the remaining frames failed or the workers
+                            died, after cleanup
+        """
+        out, errors = [], []
+        if self.blocks is None:
+            return out
+        try:
+            while self.emit_seq < self.next_seq:
+                if self.emit_seq not in self.reorder:
+                    self.wait()
+                self.advance()
+            while self.done:
+                try:
+                    out.extend(self.ready())
+                except RuntimeError as error:
+                    errors.append(str(error))
+        finally:
+            for __ in self.processes:
+                self.tasks.put(None)
+            for process in self.processes:
+                process.join(timeout)
+                if process.is_alive():
+                    process.terminate()
+            for block in self.blocks:
+                block.close()
+                block.unlink()
+            self.blocks = None
+            self.processes = []
+            self.reorder = {}
+            self.done.clear()
+        if errors:
+            raise RuntimeError("; ".join(errors))
+        return out
+
+
+def main():
+    import time
+    import bre_preprocess_module as bre_preprocess
+    cap = bre_preprocess.Video(id = 1, camera_number = 0, threaded = True)
+    pool = PreprocessPool()
+    start, done = time.time(), 0
+    try:
+        while True:
+            done += len(pool.submit(cap.read_next_video_frame()))
+            if time.time() - start > 1.0:
+                print(f"{done/(time.time() - start):.1f} frames/s with {pool.workers} workers")
+                start, done = time.time(), 0
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pool.close()
+        cap.release()
+
+if __name__ == "__main__":
+    main()
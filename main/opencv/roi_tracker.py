@@ -0,0 +1,146 @@
+"""A panel ROI tracker for button recognition.
+
+#Input:         Camera frames
+#Output:        Candidate boxes in full frame coordinates, compute saved
+#Assumptions:   The elevator panel moves little between frames
+
+The full frame is searched only until the panel is found. After that only
+a padded region around the panel is processed:
+    the ROI follows the boxes found inside it
+    a full frame detection is run every redetect_every frames
+    or as soon as fewer boxes than min_confidence * reference are found
+ROI sizes are rounded up to multiples of 32px, so the pipeline buffers
+are reused for most frames.
+
+Typical usage example:
+
+  pipe = Pipeline(DEFAULT_STAGES)
+  tracker = PanelTracker(lambda image: pipe.run(image)["boxes"])
+  boxes = tracker.process(frame)
+  print(tracker.saved())
+"""
+import numpy as np
+
+ROI_STEP = 32
+
+
+class PanelTracker:
+    """Tracks the panel ROI and runs the detection only inside it.
+
+    Attributes:
+        detect:                 Callable returning (N,4,2) boxes of an image
+        padding:                Padding around the panel, relative to its size
+        redetect_every:         Number of frames after which the full frame is searched again
+        min_confidence:         Fraction of the reference box count needed to keep tracking
+        roi:                    (x, y, w, h) of the tracked panel or None
+        reference:              Number of boxes found by the last full frame detection
+        confidence:             Boxes found in the ROI / reference, for the last frame
+        pixels_processed:       Number of pixels the detection ran on
+        pixels_total:           Number of pixels of all processed frames
+
+    Methods:
+        process:                Returns the boxes of a frame, in full frame coordinates
+        detect_full:            Searches the whole frame and locks the ROI
+        detect_roi:             Searches the padded ROI only
+        update_roi:             Sets the ROI around the given boxes
+        padded_roi:             Returns the padded, rounded and clipped ROI slice bounds
+        saved:                  Returns the fraction of pixels not processed
+    """
+
+    def __init__(self, detect, padding=0.15, redetect_every=30, min_confidence=0.6):
+        """Initializes the tracker, the first frame is always searched fully."""
+        self.detect = detect
+        self.padding = padding
+        self.redetect_every = redetect_every
+        self.min_confidence = min_confidence
+        self.roi = None
+        self.reference = 0
+        self.confidence = 0.0
+        self.since_full = 0
+        self.full_detections = 0
+        self.pixels_processed = 0
+        self.pixels_total = 0
+
+    def process(self, frame):
+        """Returns the boxes of a frame, in full frame coordinates."""
+        self.pixels_total += frame.shape[0] * frame.shape[1]
+        if self.roi is not None and self.since_full < self.redetect_every:
+            boxes = self.detect_roi(frame)
+            if self.confidence >= self.min_confidence:
+                self.since_full += 1
+                return boxes
+        return self.detect_full(frame)
+
+    def detect_full(self, frame):
+        """Searches the whole frame and locks the ROI if anything was found."""
+        boxes = np.asarray(self.detect(frame)).reshape(-1, 4, 2)
+        self.pixels_processed += frame.shape[0] * frame.shape[1]
+        self.full_detections += 1
+        self.since_full = 0
+        self.reference = len(boxes)
+        self.confidence = 1.0 if len(boxes) else 0.0
+        self.update_roi(boxes)
+        return boxes
+
+    def detect_roi(self, frame):
+        """Searches the padded ROI and moves the ROI with the found boxes."""
+        x_1, y_1, x_2, y_2 = self.padded_roi(frame.shape)
+        boxes = np.asarray(self.detect(frame[y_1:y_2, x_1:x_2])).reshape(-1, 4, 2)
+        boxes = boxes + (x_1, y_1)
+        self.pixels_processed += (x_2 - x_1) * (y_2 - y_1)
+        self.confidence = len(boxes) / self.reference
+        if self.confidence >= self.min_confidence:
+            self.update_roi(boxes)
+        return boxes
+
+    def update_roi(self, boxes):
+        """Sets the ROI to the bounding rectangle of all boxes, None if there are none."""
+        if not len(boxes):
+            self.roi = None
+            return
+        x_min, y_min = boxes.reshape(-1, 2).min(axis=0)
+        x_max, y_max = boxes.reshape(-1, 2).max(axis=0)
+        self.roi = (int(x_min), int(y_min), int(x_max - x_min), int(y_max - y_min))
+
+    def padded_roi(self, shape):
+        """Returns (x_1, y_1, x_2, y_2) of the padded ROI clipped to the frame.
+
+        Width and height are rounded up to multiples of ROI_STEP.
+        """
+        x, y, w, h = self.roi
+        pad_x, pad_y = int(w * self.padding) + 1, int(h * self.padding) + 1
+        w = -(-(w + 2*pad_x) // ROI_STEP) * ROI_STEP
+        h = -(-(h + 2*pad_y) // ROI_STEP) * ROI_STEP
+        x_1 = min(max(x - pad_x, 0), max(shape[1] - w, 0))
+        y_1 = min(max(y - pad_y, 0), max(shape[0] - h, 0))
+        return x_1, y_1, min(x_1 + w, shape[1]), min(y_1 + h, shape[0])
+
+    def saved(self):
+        """Returns the fraction of pixels the detection did not have to process."""
+        if self.pixels_total == 0:
+            return 0.0
+        return 1.0 - self.pixels_processed / self.pixels_total
+
+
+def main():
+    import cv2
+    import bre_preprocess_module as bre_preprocess
+    from preprocess_pipeline import Pipeline
+    from preprocess_pool import DEFAULT_STAGES
+    cap = bre_preprocess.Video(id = 1, camera_number = 0, threaded = True)
+    pipe = Pipeline(DEFAULT_STAGES)
+    tracker = PanelTracker(lambda image: pipe.run(image)["boxes"])
+    try:
+        while True:
+            frame = cap.read_next_video_frame()
+            boxes = tracker.process(frame)
+            print(f"{len(boxes)} boxes | ROI {tracker.roi} | saved {tracker.saved()*100:.0f}%")
+            cv2.imshow("boxes", cv2.drawContours(frame.copy(), list(boxes), -1, (0, 0, 255), 2))
+            if cv2.waitKey(1) & 0xFF == ord("q"):
+                break
+    finally:
+        cap.release()
+        cv2.destroyAllWindows()
+
+if __name__ == "__main__":
+    main()
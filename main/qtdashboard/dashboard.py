@@ -7,13 +7,24 @@ processing. See API and Usage Examples for details.
 """
 import os
 import sys
+import threading
+import time
 
 from PyQt5 import QtCore, QtGui, uic, QtWidgets
 
 import cv2
-from main.common import coms
-from main.opencv import preprocess, bre_postprocess
-import settings
+import numpy as np
+try:
+    from main.common import coms
+except ImportError:
+    #Run as a script from main/qtdashboard, coms and the opencv modules live in sibling packages
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+    from main.common import coms
+from main.opencv import preprocess, bre_preprocess_module as bre_preprocess
+try:
+    from main.qtdashboard import settings
+except ImportError:
+    import settings
 
 
 class App():
@@ -35,7 +46,8 @@ class OwnImageWidget(QtWidgets.QWidget):
         """Sets the Image in ImageWidget using QPainter"""
         self.image = image
         sz_qsize = image.size()         #QSize
-        self.setMinimumSize(sz_qsize)   #Widget cant be smaller than image size
+        if sz_qsize != self.minimumSize():
+            self.setMinimumSize(sz_qsize)   #Widget cant be smaller than image size
         self.update()                   #Schedules a PAINTEVENT for Qt main event loop
 
     def paintEvent(self, __):
@@ -46,13 +58,295 @@ class OwnImageWidget(QtWidgets.QWidget):
             qtpainter.drawImage(QtCore.QPoint(0, 0), self.image) #Draws image at topleft corner
         qtpainter.end()                 #Kills the QPainter instance
 
+#Qt >= 5.14 shows BGR buffers directly, older versions need a BGR->RGB conversion
+FORMAT_BGR888 = getattr(QtGui.QImage, "Format_BGR888", None)
+#Parameter boxes of every subtab, their values are sent on valueChanged
+PARAM_WIDGETS = {"AdjustBrightness": {"prepro_BRIGHTNESS": "prepro_brightness_box",
+                                      "prepro_CONTRAST": "prepro_contrast_box"}}
+#All parameters are published on one ParameterBus on this port
+PARAMETER_PORT = coms.PARAMETER_PORT
+#Changes arriving within this many ms of the first one are sent together
+PARAM_COALESCE_MS = 5
+#Feeds of the grid mode, published by bre_preprocess.StagePublisher
+FEEDS = [{"name": name, "port": port} for name, port in bre_preprocess.STAGE_PORTS.items()]
+
+def read_hub(resources, key, timeout=100):
+    """Receives the newest frame of a hub registered in resources, for a FrameWorker.
+
+    A conflating PUB_SUB hub keeps only the newest frame in its own thread,
+    so frames published while the worker was busy or capped are never decoded.
+    REQ_REP and DEALER_ROUTER hubs are answered.
+
+    Returns:
+        src_name:       Name of the source
+        src_image:      The frame, None when nothing arrived within timeout ms
+    """
+    image_hub = resources.get(key)
+    if image_hub.conflate:
+        src_name, src_image = image_hub.get_latest(timeout)
+        if src_image is None:
+            return "NO FRAME RECEIVED", None
+        return src_name, src_image
+    if not image_hub.poll(timeout):
+        return "NO FRAME RECEIVED", None
+    src_name, src_image = image_hub.recv()
+    if image_hub.mode != 'PUB_SUB':
+        image_hub.send_reply()
+    return src_name, src_image
+
+class FrameWorker(QtCore.QThread):
+    """Receives frames and renders them to QImages off the GUI thread.
+
+    Frames are resized straight into one of three persistent buffers, each
+    backing a QImage: one is shown by the widget, one waits to be taken by
+    the GUI and one is written by this thread, so no buffer is allocated
+    per frame and the shown one is never overwritten.
+
+    Attributes:
+        read_frame:             Callable returning (name, frame), frame is None when there is none
+        target_size:            (width, height) the frames are scaled to fit in
+        max_fps:                Maximal number of frames read per second, None for no cap
+        running:                Boolean, the thread stops when set to False
+        sizes:                  Dictionary of (source height, width, target_size) and the cached
+                                (width, height, interpolation) the source is shown at
+        slots:                  List of three (array, QImage) buffers, None until first used
+        ready:                  Index of the slot waiting to be taken, None when there is no new frame
+        shown:                  Index of the slot taken last by the GUI
+
+    Methods:
+        run:                    Reads and renders frames until stopped
+        display_size:           Returns the cached display size of a source resolution
+        slot_buffer:            Returns the array of a slot, (re)allocated for the needed size
+        render:                 Resizes a BGR or gray frame into a free slot
+        take:                   Returns the newest rendered frame, called from the GUI thread
+        stop:                   Stops the thread
+
+    Signals:
+        frame_ready:            Emitted for a new frame, unless the GUI has not taken the last one yet
+        error:                  Emitted with the message when reading or rendering a frame failed,
+                                once per distinct error until a frame succeeds again
+    """
+    frame_ready = QtCore.pyqtSignal()
+    error = QtCore.pyqtSignal(str)
+
+    def __init__(self, read_frame, target_size, parent=None, max_fps=None):
+        """Defines initial variables and inheritence."""
+        super(FrameWorker, self).__init__(parent)
+        self.read_frame = read_frame
+        self.target_size = target_size
+        self.max_fps = max_fps
+        self.last_read = 0.0
+        self.running = True
+        self.lock = threading.Lock()
+        self.name = "FEED NOT RUNNING"
+        self.sizes = {}
+        self.slots = [None, None, None]
+        self.ready = None
+        self.shown = None
+        self.pending = False
+        self.last_error = None
+
+    def run(self):
+        """Reads and renders frames until stopped.
+
+        Only the newest frame is kept; when the GUI is slower than the feed,
+        the waiting frame is replaced instead of queued, so the widget repaints
+        at display rate whatever the network rate is. An exception is sent to
+        the GUI with the error signal and the frame is retried after 500 ms,
+        so a failing feed never takes the application down.
+        """
+        while self.running:
+            if self.max_fps:
+                wait = self.last_read + 1.0/self.max_fps - time.monotonic()
+                if wait > 0:
+                    self.msleep(int(wait * 1000))
+            self.last_read = time.monotonic()
+            try:
+                name, frame = self.read_frame()
+                index = None if frame is None else self.render(frame)
+            except Exception as error:
+                message = f"{type(error).__name__}: {error}"
+                if message != self.last_error:
+                    self.last_error = message
+                    self.error.emit(message)
+                self.msleep(500)
+                continue
+            self.last_error = None
+            with self.lock:
+                self.name = name
+                if index is not None:
+                    self.ready = index
+                notify = not self.pending
+                self.pending = True
+            if notify:
+                self.frame_ready.emit()
+            if frame is None:
+                self.msleep(50)
+
+    def display_size(self, shape):
+        """Returns the cached (width, height, interpolation) a source resolution is shown at.
+
+        Downscaling uses INTER_AREA, upscaling the cheaper INTER_LINEAR.
+        """
+        key = (shape[0], shape[1], self.target_size)
+        if key not in self.sizes:
+            img_height, img_width = shape[:2]
+            window_width, window_height = self.target_size
+            #Scale the image to fit the window
+            scale = min(float(window_width) / float(img_width), float(window_height) / float(img_height))
+            if scale == 0:
+                scale = 1
+            width = max(int(round(img_width * scale)), 1)
+            height = max(int(round(img_height * scale)), 1)
+            interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR
+            self.sizes[key] = (width, height, interpolation)
+        return self.sizes[key]
+
+    def slot_buffer(self, index, width, height, channels):
+        """Returns the array of a slot, reallocating it and its QImage when the size changed."""
+        shape = (height, width) if channels == 1 else (height, width, channels)
+        if self.slots[index] is None or self.slots[index][0].shape != shape:
+            array = np.empty(shape, dtype=np.uint8)
+            if channels == 1:
+                image_format = QtGui.QImage.Format_Grayscale8
+            else:
+                image_format = FORMAT_BGR888 or QtGui.QImage.Format_RGB888
+            #The QImage shares the array memory, the slot keeps both alive
+            image = QtGui.QImage(array.data, width, height, width * channels, image_format)
+            self.slots[index] = (array, image)
+        return self.slots[index][0]
+
+    def render(self, frame):
+        """Resizes the frame into a slot that is neither shown nor waiting, returns its index."""
+        width, height, interpolation = self.display_size(frame.shape)
+        with self.lock:
+            index = next(i for i in range(3) if i != self.ready and i != self.shown)
+        channels = 1 if frame.ndim == 2 else 3
+        buffer = self.slot_buffer(index, width, height, channels)
+        if channels == 1 or FORMAT_BGR888 is not None:
+            cv2.resize(frame, (width, height), dst=buffer, interpolation=interpolation)
+        else:
+            img = cv2.resize(frame, (width, height), interpolation=interpolation)
+            cv2.cvtColor(img, cv2.COLOR_BGR2RGB, dst=buffer)
+        return index
+
+    def take(self):
+        """Returns the source name and the QImage of the newest frame.
+
+        The image is None when no new frame was rendered since the last take,
+        so the GUI repaints only on new frames.
+        """
+        with self.lock:
+            self.pending = False
+            image = None
+            if self.ready is not None:
+                self.shown, self.ready = self.ready, None
+                image = self.slots[self.shown][1]
+            return self.name, image
+
+    def stop(self):
+        """Stops the thread and waits for it to finish."""
+        self.running = False
+        self.wait()
+
+class FeedView(QtWidgets.QGroupBox):
+    """One feed of the grid, with its own image widget and FrameWorker.
+
+    Attributes:
+        name:                   Name of the feed, shown in the title
+        image_widget:           OwnImageWidget showing the feed
+        worker:                 FrameWorker reading and rendering the feed
+
+    Methods:
+        update_frame:           Shows the newest frame rendered by the worker
+        show_error:             Shows an error of the worker in the title
+        stop:                   Stops the worker
+    """
+
+    def __init__(self, name, read_frame, target_size, max_fps=None, parent=None):
+        """Creates the widgets and starts the worker."""
+        super(FeedView, self).__init__(name, parent)
+        self.name = name
+        self.src_name = None
+        self.image_widget = OwnImageWidget(self)
+        layout = QtWidgets.QVBoxLayout(self)
+        layout.addWidget(self.image_widget)
+        self.worker = FrameWorker(read_frame, target_size, self, max_fps=max_fps)
+        self.worker.frame_ready.connect(self.update_frame)
+        self.worker.error.connect(self.show_error)
+        self.worker.start()
+
+    def show_error(self, message):
+        """Shows an error of the worker in the title until the next frame arrives."""
+        self.src_name = None
+        self.setTitle(f"{self.name}: {message}")
+
+    def update_frame(self):
+        """Shows the newest frame rendered by the worker."""
+        src_name, image = self.worker.take()
+        if src_name != self.src_name:
+            self.src_name = src_name
+            self.setTitle(f"{self.name}: {src_name}")
+        if image is not None:
+            self.image_widget.setImage(image)
+
+    def stop(self):
+        """Stops the worker."""
+        self.worker.stop()
+
+class FeedGrid(QtWidgets.QWidget):
+    """Shows several camera or pipeline stage feeds in a grid.
+
+    Every feed has its own hub, receive thread, frame rate cap and downscale
+    target, so a slow or busy feed does not throttle the others.
+
+    Attributes:
+        resources:              coms.ResourceManager keeping the hubs of all feeds open
+        feeds:                  Dictionary of feed name and its FeedView
+        columns:                Number of feeds per grid row
+
+    Methods:
+        add_feed:               Registers the hub of a feed and adds its view to the grid
+        closeEvent:             Stops all feeds and closes their hubs
+    """
+
+    def __init__(self, feeds=FEEDS, columns=2, parent=None):
+        """Creates the grid and one view per feed."""
+        super(FeedGrid, self).__init__(parent)
+        self.resources = coms.ResourceManager()
+        self.grid = QtWidgets.QGridLayout(self)
+        self.columns = columns
+        self.feeds = {}
+        for feed in feeds:
+            self.add_feed(**feed)
+
+    def add_feed(self, name, port, mode="PUB_SUB", max_fps=15, target_size=(480, 360)):
+        """Registers the hub of a feed and adds its view to the next grid cell."""
+        if name in self.feeds:
+            raise ValueError(f"{name} is already present")
+        key = ("feed", name)
+        self.resources.register(key, lambda: coms.ComInst(direction='recv', port=port, mode=mode,
+                                                          conflate=(mode == 'PUB_SUB')),
+                                check=coms.ComInst.is_open)
+        view = FeedView(name, lambda: read_hub(self.resources, key), target_size, max_fps, self)
+        row, column = divmod(len(self.feeds), self.columns)
+        self.grid.addWidget(view, row, column)
+        self.feeds[name] = view
+        return view
+
+    def closeEvent(self, __):
+        """Stops all feeds and closes their hubs."""
+        for view in self.feeds.values():
+            view.stop()
+        self.resources.close_all()
+
 class Dashboard(QtWidgets.QMainWindow, App.form_class):
     """Main class that encompases the whole Dashboard GUI object.
     Attributes:
-        image_hub
+        resources:                  coms.ResourceManager keeping hubs, cameras and parameter connections open
         image_name
         running
-        frame
+        frame_worker:               FrameWorker receiving and rendering frames off the GUI thread
         open_subtab_now
         open_subtab_last
         open_tab_now
@@ -67,11 +361,12 @@ class Dashboard(QtWidgets.QMainWindow, App.form_class):
         QtWidgets.QMainWindow.__init__(self, parent)
         self.setupUi(self)
         #INIT DEFAULT VARIABLES
-        self.image_hub = None
+        self.resources = coms.ResourceManager()
         self.image_name = "UNKNOWN SOURCE"
         self.running = False
-        self.frame = None
+        self.img_name = self.image_name
         self.show_feed = True
+        self.feed_error = False
         #CUSTOM SLOTS AND SIGNALS
         self.prepro_adjbr_toggle.toggled.connect(self.toggle_clicked)
         self.prepro_adjbr_toggle.toggled.connect(self.set_qgroup_title)
@@ -85,28 +380,53 @@ class Dashboard(QtWidgets.QMainWindow, App.form_class):
         #SCRIPT ALWAYS STARTS ON THESE
         self.subtab = "AdjustBrightness"
         self.tab = "Preprocessing"
-        #INIT PARAMETER OBJECTS
-        self.prepro_bundles = self.init_params(self.subtab)
-        #INIT COMMUNICATION OBJECTS
-        self.params = self.create_params(self.prepro_bundles)
-        #INIT TIMERS AND THEIR CALLS
-        self.timer = QtCore.QTimer(self)
-        self.timer.timeout.connect(self.update_frame)
-        self.timer.start(1)
-
-        self.slow_timer = QtCore.QTimer(self)
-        self.slow_timer.timeout.connect(self.read_par_values)
-        self.slow_timer.timeout.connect(self.update_parameters)
-        self.slow_timer.start(50)
+        #REGISTER RESOURCES, THEY ARE OPENED ON FIRST USE AND KEPT OPEN
+        self.register_resources()
+        #INIT PARAMETER AND COMMUNICATION OBJECTS
+        self.params = self.subtab_params(self.subtab)
+        #INIT FRAME WORKER, IT RECEIVES AND RENDERS OFF THE GUI THREAD
+        self.frame_worker = FrameWorker(self.read_next, (self.window_width, self.window_height), self)
+        self.frame_worker.frame_ready.connect(self.update_frame)
+        self.frame_worker.error.connect(self.show_error)
+        self.frame_worker.start()
+        #INIT TIMERS AND THEIR CALLS, A BURST OF PARAMETER CHANGES IS SENT ONCE
+        self.dirty_subtabs = set()
+        self.param_timer = QtCore.QTimer(self)
+        self.param_timer.setSingleShot(True)
+        self.param_timer.setInterval(PARAM_COALESCE_MS)
+        self.param_timer.timeout.connect(self.update_parameters)
+        self.connect_parameter_widgets()
 
     def change_feed(self):
         pass
 
+    def register_resources(self):
+        """Registers the hubs and capture devices used by the feeds."""
+        self.resources.register("image_hub",
+                                lambda: coms.ComInst(direction='recv', port=5555, mode='REQ_REP'),
+                                check=coms.ComInst.is_open)
+        self.resources.register("camera",
+                                lambda: bre_preprocess.Video(id = 1, camera_number = 0, threaded = True),
+                                check=lambda cap: cap.VideoFeed.isOpened())
+        self.resources.register("parameter_bus",
+                                lambda: coms.ParameterBus('send', port=PARAMETER_PORT),
+                                check=coms.ParameterBus.is_open)
+        self.resources.register("preprocess",
+                                lambda: bre_preprocess.Preprocess(id = 1, video_instance = self.resources.get("camera")),
+                                check=lambda prepro: prepro.video_instance is self.resources.get("camera"),
+                                close=lambda prepro: None)
+
+    def subtab_params(self, subtab):
+        """Returns the Parameters of a subtab, their connections stay open across tab switches."""
+        key = ("params", subtab)
+        if key not in self.resources.factories:
+            self.resources.register(key, lambda: self.create_params(self.init_params(subtab)))
+        return self.resources.get(key)
+
     def tab_change(self):
-        """Detects change of tab, closes old parameters and initiates new ones."""
-        self.close_parameters()
+        """Detects change of tab, switches to the parameters of the new subtab."""
         self.subtab = self.subtab_curr()
-        self.init_params(self.subtab)
+        self.params = self.subtab_params(self.subtab)
 
     def tab_curr(self):
         """Returns the current opened tab."""
@@ -120,10 +440,9 @@ class Dashboard(QtWidgets.QMainWindow, App.form_class):
         return subtab_name_qstring
         
     def subtab_change(self):
-        """Detects change of subtab, closes old parameters and initiates new ones."""
-        self.close_parameters()
+        """Detects change of subtab, switches to the parameters of the new subtab."""
         self.subtab = self.subtab_curr()
-        self.init_params(self.subtab)
+        self.params = self.subtab_params(self.subtab)
         
     def toggle_clicked(self):
         """Handles the toggle button."""
@@ -143,41 +462,39 @@ class Dashboard(QtWidgets.QMainWindow, App.form_class):
             self.show_feed = False
 
     def update_frame(self):
-        """Updates the ImgWidget with the next image."""
-        self.read_next()
-        if self.frame is not None:
-            img = self.frame
+        """Shows the newest frame rendered by the frame worker."""
+        self.img_name, image = self.frame_worker.take()
+        if image is not None:
+            if self.feed_error:
+                self.feed_error = False
+                self.statusbar.clearMessage()
             self.prepro_adjbr_toggle.setText("Cam ON")
-            img_height, img_width, __ = img.shape
-            #Scale the image to fit the window
-            scale_w = float(self.window_width) / float(img_width)
-            scale_h = float(self.window_height) / float(img_height)
-            scale = min([scale_w, scale_h])
-            if scale == 0:
-                scale = 1
-            img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_CUBIC)
-            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-            #Adjust so its renderable by Qt
-            height, width, bits_per_color = img.shape
-            bits_per_line = bits_per_color * width
-            image = QtGui.QImage(img.data, width, height, bits_per_line, QtGui.QImage.Format_RGB888)
             self.prepro_ImgWidget.setImage(image)
     
+    def show_error(self, message):
+        """Shows an error of the frame worker in the status bar, the feed keeps running."""
+        self.feed_error = True
+        self.statusbar.showMessage(f"Feed error: {message}")
+
     def set_qgroup_title(self):
         """Sets the qgroub Title"""
-        self.read_next()
         self.prepro_img.setTitle(self.img_name)
 
     def read_next(self):
-        """Read next frame based on dashboard status."""
+        """Reads the next frame based on dashboard status, called by the frame worker.
+
+        Returns:
+            img_name:       Name of the source
+            frame:          The frame, None when there is none
+        """
         if self.subtab == "AdjustBrightness":
             if self.show_feed is True:
-                self.img_name, self.frame = self.camera_read_next(self.image_hub)
+                return self.camera_read_next()
             elif self.show_feed is False:
-                cap = bre_preprocess.Video(id = 1, camera_number = 0)
-                img_prepro = bre_preprocess.Preprocess(id = 1, video_instance = cap)
-                self.img_name = "AdjustBrightness"
-                self.frame = img_prepro.adjust_brightness_dynamic()
+                img_prepro = self.resources.get("preprocess")
+                img_prepro.image = img_prepro.video_instance.read_next_video_frame()
+                return "AdjustBrightness", img_prepro.adjust_brightness_dynamic()
+        return self.image_name, None
 
     def image_read_next(self, instance):
         if self.running:
@@ -193,11 +510,13 @@ class Dashboard(QtWidgets.QMainWindow, App.form_class):
     def camera_read_next(self, image_hub=None):
         """Reads the next frame from camera using image_hub object."""
         if image_hub is None:
-            image_hub = coms.ComInst(direction='recv', port=5555, mode='REQ_REP')
+            image_hub = self.resources.get("image_hub")
 
         if self.running:
+            if not image_hub.poll(100):
+                #No camera sending, return so the frame worker can be stopped
+                return "NO FRAME RECEIVED", None
             src_name, src_image = image_hub.recv()
-            #ISSUE: if camera is not initiated, this freezes the module
             image_hub.send_reply()
 
         if not self.running:
@@ -209,49 +528,59 @@ class Dashboard(QtWidgets.QMainWindow, App.form_class):
         """Returns predetermined parameters based on input tab"""
         bundles = []
         if subtab == "AdjustBrightness":
-            bundle_brightness = {"name":"prepro_BRIGHTNESS", "value":0, 
-                                 "direction":"send", "port":1001, "mode":"REQ_REP"}
-            bundle_contrast = {"name":"prepro_CONTRAST", "value":0,
-                               "direction":"send", "port":1002, "mode":"REQ_REP"}
+            bundle_brightness = {"name":"prepro_BRIGHTNESS", "value":0}
+            bundle_contrast = {"name":"prepro_CONTRAST", "value":0}
             bundles = [bundle_brightness, bundle_contrast]
         else:
             print("Params not implemented yet!")
         return bundles
 
     def create_params(self, bundles):
-        """Handles the creation of parameters and communication dictionaries."""
-        par_dict = {}
-        com_dict = {}
-        for bundle in bundles:
-            coms.create_parameter(bundle, par_dict, com_dict)
-        params = coms.Parameters(par_dict, com_dict)
-        return params
+        """Creates the parameters of bundles, all sent over the shared parameter bus.
 
-    def update_parameters(self):
-        """Calls methods to update parameters."""
-        self.params.detect_updates()
-        self.params.send_parameters()
+        When the bus can not be opened, the parameters are only tracked, so the
+        rest of the dashboard still works.
+        """
+        try:
+            bus = self.resources.get("parameter_bus")
+        except OSError as error:
+            self.statusbar.showMessage(f"Parameters are not sent: {error}")
+            return coms.Parameters({bundle["name"]: bundle["value"] for bundle in bundles})
+        return coms.bundle_parameters(bundles, bus=bus)
 
-    def read_par_values(self):
-        """Reads the value off the doubleBoxes."""
-        if self.subtab == "AdjustBrightness":
-            #Brightness par (0.00 to 1.00)
-            self.params.pars.update({"prepro_BRIGHTNESS": float(self.prepro_brightness_box.value()/100)})
-            #Contrast par (0.00 to 1.00)
-            self.params.pars.update({"prepro_CONTRAST": float(self.prepro_contrast_box.value()/100)})
-    
-    def close_parameters(self):
-        """Closes all parameter connections."""
-        for __, cominst in self.params.coms.items():
-            cominst.close()
+    def connect_parameter_widgets(self):
+        """Connects the valueChanged signal of every parameter box to its parameter."""
+        for subtab, widgets in PARAM_WIDGETS.items():
+            for key, widget_name in widgets.items():
+                box = getattr(self, widget_name)
+                box.valueChanged.connect(
+                    lambda value, subtab=subtab, key=key: self.set_parameter(subtab, key, value))
+
+    def set_parameter(self, subtab, key, value):
+        """Sets a parameter from its box, schedules one send for the whole burst of changes."""
+        #Box values are percents, parameters go from 0.00 to 1.00
+        self.subtab_params(subtab).set(key, float(value/100))
+        self.dirty_subtabs.add(subtab)
+        if not self.param_timer.isActive():
+            self.param_timer.start()
 
+    def update_parameters(self):
+        """Sends the parameters changed since the last call."""
+        for subtab in self.dirty_subtabs:
+            self.subtab_params(subtab).flush()
+        self.dirty_subtabs = set()
+    
     def closeEvent(self, __):
         """Handles what happens after the window is closed."""
         self.running = False
-        self.close_parameters()
+        self.frame_worker.stop()
+        self.resources.close_all()
 
 if __name__ == "__main__":
-    w = Dashboard(None)
+    if "grid" in sys.argv[1:]:
+        w = FeedGrid(FEEDS)
+    else:
+        w = Dashboard(None)
     w.setWindowTitle("Testing")
     w.show()
     App.app.exec_()
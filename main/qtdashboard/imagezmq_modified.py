@@ -9,6 +9,19 @@ Copyright (c) 2019 by Jeff Bass.
 License: MIT, see LICENSE for more details.
 """
 
+import collections
+import itertools
+import json
+import os
+import socket
+import struct
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+
+import cv2
 import zmq
 import numpy as np
 
@@ -20,9 +33,11 @@ class ImageSender():
     related text messages to the hub computer. Provides methods to
     send images or send jpg compressed images.
 
-    Two kinds of ZMQ message patterns are possible in imagezmq:
+    Three kinds of ZMQ message patterns are possible in imagezmq:
     REQ/REP: an image is sent and the sender waits for a reply ("blocking").
     PUB/SUB: an images is sent and no reply is sent or expected ("non-blocking").
+    DEALER/ROUTER: images are sent without waiting, up to a window of frames
+                   in flight; every frame is still acknowledged ("pipelined").
 
     There are advantabes and disadvantages for each message pattern.
     See the documentation for a full description of REQ/REP and PUB/SUB.
@@ -30,11 +45,23 @@ class ImageSender():
 
     Arguments:
       connect_to: the tcp address:port of the hub computer.
-      REQ_REP: (optional) if True (the default), a REQ socket will be created
-                          if False, a PUB socket will be created
+      mode: (optional) 'REQ_REP' (the default) creates a REQ socket,
+                       'PUB_SUB' creates a PUB socket,
+                       'DEALER_ROUTER' creates a DEALER socket
+      window: (optional) max number of unacknowledged frames in DEALER_ROUTER mode
+      shm_slots: (optional) if set, frames are written into a ring of this many
+                 shared memory slots and only their location is sent over zmq;
+                 usable only when the hub runs on the same host
+      source_id: (optional) number sent in every frame header to tell senders apart,
+                 defaults to a number derived from the hostname, the process id
+                 and a counter of the senders in the process, see default_source_id()
+      compress: (optional) if True, send_image encodes frames to jpg in a thread
+                pool and adapts quality and resolution to the link
+      encoder_threads: (optional) number of jpg encoding threads when compressing
     """
 
-    def __init__(self, connect_to='tcp://127.0.0.1:5555', mode = 'REQ_REP'):
+    def __init__(self, connect_to='tcp://127.0.0.1:5555', mode = 'REQ_REP', window=4,
+                 shm_slots=None, source_id=None, compress=False, encoder_threads=2):
         """Initializes zmq socket for sending images to the hub.
 
         Expects an appropriate ZMQ socket at the connect_to tcp:port address:
@@ -43,15 +70,50 @@ class ImageSender():
 
         If mode is PUB_SUB, then a PUB socket is created. It must connect to
         a matching SUB socket on the ImageHub().
+
+        If mode is DEALER_ROUTER, then a DEALER socket is created. It must
+        connect to a matching ROUTER socket on the ImageHub().
+
+        With shm_slots set, any of the modes carries only slot metadata, so the
+        connect_to address would typically be an ipc:// endpoint. In PUB_SUB
+        mode, or with a window larger than shm_slots, a slow hub may find a
+        slot already overwritten; it then drops that frame.
+
+        With compress set, send_image sends jpg buffers instead of raw arrays;
+        this is meant for remote hubs and can not be combined with shm_slots.
         """
+        if compress and shm_slots is not None:
+            raise ValueError("Compressed frames can not be sent through shared memory.")
+        self.shm_ring = None
+        if shm_slots is not None:
+            self.shm_ring = SharedFrameRing(shm_slots)
         if mode == 'REQ_REP':
              # REQ/REP mode, this is a blocking scenario
              self.init_reqrep(connect_to)
+        elif mode == 'DEALER_ROUTER':
+             # DEALER/ROUTER mode, pipelined scenario with credit flow control
+             self.init_dealerrouter(connect_to, window)
         else:
              #PUB/SUB mode, non-blocking scenario
              self.init_pubsub(connect_to)
 
         self.mode = mode
+        self.zmq_socket.source_id = default_source_id() if source_id is None else source_id
+
+        self.encoder = None
+        if compress:
+            self.init_compressed(encoder_threads)
+
+    def init_compressed(self, threads):
+        """Replaces send_image with the compressing variant.
+
+        Frames are encoded by an AdaptiveJpegEncoder and sent with the
+        send_jpg method of the chosen mode, in capture order.
+        """
+        self.encoder = AdaptiveJpegEncoder(threads=threads)
+        self.pending = collections.deque()      # (msg, timestamp, encoding future)
+        self.sent_nbytes = {}                   # sequence -> jpg size, DEALER/ROUTER only
+        self.send_image = self.send_image_compressed
 
     def init_reqrep(self, address):
         """ Creates and inits a socket in REQ/REP mode
@@ -79,6 +141,31 @@ class ImageSender():
         self.send_image = self.send_image_pubsub
         self.send_jpg   = self.send_jpg_pubsub
 
+    def init_dealerrouter(self, address, window):
+        """Creates and inits a socket in DEALER/ROUTER mode
+
+        Every frame consumes one credit, every reply from the hub returns one.
+        When there are no credits left the sender waits for a reply, so at most
+        window frames are ever in flight.
+        """
+        if window < 1:
+            raise ValueError("Window must be at least 1 frame.")
+
+        socketType = zmq.DEALER
+        self.zmq_context = SerializingContext()
+        self.zmq_socket = self.zmq_context.socket(socketType)
+        self.zmq_socket.connect(address)
+
+        self.window = window
+        self.credits = window
+        self.sequence = 0
+        self.in_flight = collections.OrderedDict()  # sequence -> send time
+        self.acks = collections.deque()             # (sequence, reply, round trip)
+
+        # Assign corresponding send methods for DEALER/ROUTER mode
+        self.send_image = self.send_image_dealer
+        self.send_jpg   = self.send_jpg_dealer
+
     def send_image(self, msg, image):
         """ This is a placeholder. This method will be set to either a REQ/REP
         or PUB/SUB sending method, depending on REQ_REP option value.
@@ -93,28 +180,43 @@ class ImageSender():
         """
         pass
 
-    def send_image_reqrep(self, msg, image):
-        """Sends OpenCV image and msg to hub computer in REQ/REP mode
+    def send_frame(self, msg, image, timestamp=None):
+        """Sends the image over the socket, or through the shared memory ring
+        if one was requested.
 
         Arguments:
           msg: text message or image name.
           image: OpenCV image to send to hub.
-
-        Returns:
-          A text reply from hub.
+          timestamp: (optional) capture time of the image, defaults to now.
         """
 
-        if image.flags['C_CONTIGUOUS']:
+        if self.shm_ring is not None:
+            self.zmq_socket.send_shm_array(self.shm_ring, image, msg, timestamp=timestamp)
+        elif image.flags['C_CONTIGUOUS']:
             # if image is already contiguous in memory just send it
-            self.zmq_socket.send_array(image, msg, copy=False)
+            self.zmq_socket.send_array(image, msg, copy=False, timestamp=timestamp)
         else:
             # else make it contiguous before sending
             image = np.ascontiguousarray(image)
-            self.zmq_socket.send_array(image, msg, copy=False)
+            self.zmq_socket.send_array(image, msg, copy=False, timestamp=timestamp)
+
+    def send_image_reqrep(self, msg, image, timestamp=None):
+        """Sends OpenCV image and msg to hub computer in REQ/REP mode
+
+        Arguments:
+          msg: text message or image name.
+          image: OpenCV image to send to hub.
+          timestamp: (optional) capture time of the image, defaults to now.
+
+        Returns:
+          A text reply from hub.
+        """
+
+        self.send_frame(msg, image, timestamp)
         hub_reply = self.zmq_socket.recv()  # receive the reply message
         return hub_reply
 
-    def send_image_pubsub(self, msg, image):
+    def send_image_pubsub(self, msg, image, timestamp=None):
         """Sends OpenCV image and msg hub computer in PUB/SUB mode. If
         there is no hub computer subscribed to this socket, then image and msg
         are discarded.
@@ -122,18 +224,13 @@ class ImageSender():
         Arguments:
           msg: text message or image name.
           image: OpenCV image to send to hub.
+          timestamp: (optional) capture time of the image, defaults to now.
 
         Returns:
           Nothing; there is no reply from hub computer in PUB/SUB mode
         """
 
-        if image.flags['C_CONTIGUOUS']:
-            # if image is already contiguous in memory just send it
-            self.zmq_socket.send_array(image, msg, copy=False)
-        else:
-            # else make it contiguous before sending
-            image = np.ascontiguousarray(image)
-            self.zmq_socket.send_array(image, msg, copy=False)
+        self.send_frame(msg, image, timestamp)
 
     def send_jpg(self, msg, jpg_buffer):
         """This is a placeholder. This method will be set to either a REQ/REP
@@ -147,22 +244,23 @@ class ImageSender():
           A text reply from hub in REQ/REP mode or nothing in PUB/SUB mode.
         """
 
-    def send_jpg_reqrep(self, msg, jpg_buffer):
+    def send_jpg_reqrep(self, msg, jpg_buffer, timestamp=None):
         """Sends msg text and jpg buffer to hub computer in REQ/REP mode.
 
         Arguments:
           msg: image name or message text.
           jpg_buffer: bytestring containing the jpg image to send to hub.
+          timestamp: (optional) capture time of the image, defaults to now.
 
         Returns:
           A text reply from hub.
         """
 
-        self.zmq_socket.send_jpg(msg, jpg_buffer, copy=False)
+        self.zmq_socket.send_jpg(msg, jpg_buffer, copy=False, timestamp=timestamp)
         hub_reply = self.zmq_socket.recv()  # receive the reply message
         return hub_reply
 
-    def send_jpg_pubsub(self, msg, jpg_buffer):
+    def send_jpg_pubsub(self, msg, jpg_buffer, timestamp=None):
         """Sends msg text and jpg buffer to hub computer in PUB/SUB mode. If
         there is no hub computer subscribed to this socket, then image and msg
         are discarded.
@@ -170,20 +268,198 @@ class ImageSender():
         Arguments:
           msg: image name or message text.
           jpg_buffer: bytestring containing the jpg image to send to hub.
+          timestamp: (optional) capture time of the image, defaults to now.
 
         Returns:
           Nothing; there is no reply from the hub computer in PUB/SUB mode.
         """
 
-        self.zmq_socket.send_jpg(msg, jpg_buffer, copy=False)
+        self.zmq_socket.send_jpg(msg, jpg_buffer, copy=False, timestamp=timestamp)
+
+    def send_image_dealer(self, msg, image, timestamp=None):
+        """Sends OpenCV image and msg to hub computer in DEALER/ROUTER mode.
+        Waits only if the in-flight window is full.
+
+        Arguments:
+          msg: text message or image name.
+          image: OpenCV image to send to hub.
+          timestamp: (optional) capture time of the image, defaults to now.
+
+        Returns:
+          A list of (sequence, reply, round trip) acknowledgements received
+          since the last call.
+        """
+
+        self.acquire_credit()
+        self.zmq_socket.send(self.next_sequence(), zmq.SNDMORE)
+        self.send_frame(msg, image, timestamp)
+        return self.collect_acks()
+
+    def send_jpg_dealer(self, msg, jpg_buffer, timestamp=None):
+        """Sends msg text and jpg buffer to hub computer in DEALER/ROUTER mode.
+        Waits only if the in-flight window is full.
+
+        Arguments:
+          msg: image name or message text.
+          jpg_buffer: bytestring containing the jpg image to send to hub.
+          timestamp: (optional) capture time of the image, defaults to now.
+
+        Returns:
+          A list of (sequence, reply, round trip) acknowledgements received
+          since the last call.
+        """
+
+        self.acquire_credit()
+        self.zmq_socket.send(self.next_sequence(), zmq.SNDMORE)
+        self.zmq_socket.send_jpg(msg, jpg_buffer, copy=False, timestamp=timestamp)
+        return self.collect_acks()
+
+    def send_image_compressed(self, msg, image, timestamp=None):
+        """Queues OpenCV image for jpg encoding and sends every frame whose
+        encoding is finished. The image must not be modified afterwards.
+
+        The time spent sending (REQ/REP) or the round trip of acknowledgements
+        (DEALER/ROUTER) feeds the bandwidth estimate of the encoder, the number
+        of frames still being encoded is its queue depth.
+
+        Arguments:
+          msg: text message or image name.
+          image: OpenCV image to send to hub.
+          timestamp: (optional) capture time of the image, defaults to now.
+
+        Returns:
+          The reply of the mode specific send_jpg for the last sent frame,
+          None if no frame was sent.
+        """
+
+        if timestamp is None:
+            timestamp = time.time()
+        self.pending.append((msg, timestamp, self.encoder.submit(image)))
+        replies = self.send_pending()
+        return replies[-1] if replies else None
+
+    def send_pending(self, drain=False):
+        """Sends the frames whose encoding is finished, in capture order.
+
+        Waits for an encoding only while more frames are queued than there
+        are encoding threads, or for all of them with drain.
+
+        Arguments:
+          drain: (optional) if True, sends every queued frame.
+
+        Returns:
+          A list of the replies of send_jpg for the sent frames.
+        """
+        replies = []
+        while self.pending and (drain or self.pending[0][2].done()
+                                or len(self.pending) > self.encoder.threads):
+            msg, timestamp, future = self.pending.popleft()
+            jpg_buffer = future.result()
+            if self.mode == 'DEALER_ROUTER':
+                # its ack may already come back with the reply of this send
+                self.sent_nbytes[self.sequence + 1] = jpg_buffer.nbytes
+            start = time.monotonic()
+            reply = self.send_jpg(msg, jpg_buffer, timestamp=timestamp)
+            if self.mode == 'REQ_REP':
+                self.encoder.measure(jpg_buffer.nbytes, time.monotonic() - start)
+            elif self.mode == 'DEALER_ROUTER':
+                self.measure_acks(reply)
+            self.encoder.adapt(jpg_buffer.nbytes, len(self.pending))
+            replies.append(reply)
+        return replies
+
+    def measure_acks(self, acks):
+        """Feeds the round trip of every acknowledged compressed frame to the
+        encoder, with the size of that frame."""
+        for seq, __, rtt in acks:
+            nbytes = self.sent_nbytes.pop(seq, None)
+            if nbytes is not None:
+                self.encoder.measure(nbytes, rtt)
+
+    def next_sequence(self):
+        """Takes one credit and returns the packed sequence number of the next frame."""
+        self.sequence += 1
+        self.credits -= 1
+        self.in_flight[self.sequence] = time.monotonic()
+        return struct.pack('!Q', self.sequence)
+
+    def acquire_credit(self):
+        """Receives replies until at least one frame can be sent."""
+        while self.credits == 0:
+            self.recv_ack()
+
+    def recv_ack(self, flags=0):
+        """Receives one reply from the hub and gives the credit back.
+
+        Arguments:
+          flags: (optional) zmq flags.
+        """
+        seq, reply = self.zmq_socket.recv_multipart(flags=flags)
+        seq = struct.unpack('!Q', seq)[0]
+        sent = self.in_flight.pop(seq, None)
+        rtt = None if sent is None else time.monotonic() - sent
+        self.credits += 1
+        self.acks.append((seq, reply, rtt))
+
+    def collect_acks(self):
+        """Returns all acknowledgements received so far without blocking."""
+        while self.in_flight:
+            try:
+                self.recv_ack(flags=zmq.NOBLOCK)
+            except zmq.Again:
+                break
+        acks = list(self.acks)
+        self.acks.clear()
+        return acks
+
+    def flush(self, timeout=None):
+        """Sends every frame still being encoded and, in DEALER/ROUTER mode,
+        waits until every frame in flight is acknowledged.
+
+        Arguments:
+          timeout: (optional) seconds to wait for acknowledgements,
+                   None waits indefinitely.
+
+        Returns:
+          A list of (sequence, reply, round trip) acknowledgements.
+
+        Raises:
+          TimeoutError: When the hub did not acknowledge all frames in time.
+        """
+        replies = []
+        if self.encoder is not None:
+            replies = self.send_pending(drain=True)
+        if self.mode != 'DEALER_ROUTER':
+            return []
+        acks = [ack for reply in replies for ack in reply]
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.in_flight:
+            if deadline is None:
+                self.recv_ack()
+                continue
+            remaining = int((deadline - time.monotonic())*1000)
+            if remaining <= 0 or not self.zmq_socket.poll(remaining):
+                raise TimeoutError(f"{len(self.in_flight)} frames were not acknowledged")
+            self.recv_ack()
+        acks.extend(self.collect_acks())
+        if self.encoder is not None:
+            self.measure_acks(acks)
+        return acks
 
     def close(self):
+      if self.encoder is not None:
+        # frames still being encoded are sent before the socket goes away
+        self.send_pending(drain=True)
       if self.mode == 'REQ_REP':
         # REQ/REP mode, this is a blocking scenario
         self.close_reqrep()
       else:
-        #PUB/SUB mode, non-blocking scenario
+        #PUB/SUB and DEALER/ROUTER mode, non-blocking scenario
         self.close_pubsub()
+      if self.shm_ring is not None:
+        self.shm_ring.close()
+      if self.encoder is not None:
+        self.encoder.close()
     
     def close_reqrep(self):
       self.zmq_socket.close()
@@ -212,11 +488,14 @@ class ImageHub():
     Arguments:
       open_port: (optional) the socket to open for receiving REQ requests or
                  socket to connect to for SUB requests.
-      REQ_REP: (optional) if True (the default), a REP socket will be created
-                          if False, a SUB socket will be created
+      mode: (optional) 'REQ_REP' (the default) creates a REP socket,
+                       'PUB_SUB' creates a SUB socket,
+                       'DEALER_ROUTER' creates a ROUTER socket
+      conflate: (optional) PUB_SUB only; if True, a background thread keeps
+                only the newest frame, see get_latest()
     """
 
-    def __init__(self, open_port='tcp://*:5555', mode = 'REQ_REP'):
+    def __init__(self, open_port='tcp://*:5555', mode = 'REQ_REP', conflate=False):
         """Initializes zmq socket to receive images and text.
 
         Expects an appropriate ZMQ socket at the senders tcp:port address:
@@ -226,16 +505,35 @@ class ImageHub():
         If mode is SUB_PUB, then a SUB socket is created. It must connect to
         a matching PUB socket on the ImageSender().
 
+        If mode is DEALER_ROUTER, then a ROUTER socket is created. It must
+        connect to a matching DEALER socket on the ImageSender(). Every
+        received image has to be answered with send_reply().
+
+        With conflate set, the socket belongs to a LatestFrameReceiver thread
+        and recv_image returns the newest frame instead of the next one.
         """
+        if conflate and mode != 'PUB_SUB':
+            raise ValueError("Conflating is possible only in PUB_SUB mode.")
+        self.reply_to = None
+        self.last_seq = {}          # source id -> last received sequence number
+        self.frames_dropped = 0
+        self.latency = None         # seconds between capture and receipt of the last frame
+        self.receiver = None
         if mode  == 'REQ_REP':
             #Init REP socket for blocking mode
             self.init_reqrep(open_port)
+        elif mode == 'DEALER_ROUTER':
+            #Init ROUTER socket for pipelined mode
+            self.init_dealerrouter(open_port)
         else:
             #Connect to PUB socket for non-blocking mode
-            self.init_pubsub(open_port)
+            self.init_pubsub(open_port, conflate)
 
         self.mode = mode
-        
+        if conflate:
+            self.receiver = LatestFrameReceiver(self)
+            self.receiver.start()
+
     def init_reqrep(self, address):
         """ Initializes Hub in REQ/REP mode
         """
@@ -244,15 +542,38 @@ class ImageHub():
         self.zmq_socket = self.zmq_context.socket(socketType)
         self.zmq_socket.bind(address)
 
-    def init_pubsub(self, address):
+    def init_pubsub(self, address, conflate=False):
        """ Initialize Hub in PUB/SUB mode
+
+       zmq.CONFLATE does not support multipart messages, so conflating only
+       keeps the receive queue short and LatestFrameReceiver drops the
+       older complete messages.
        """
        socketType = zmq.SUB
        self.zmq_context = SerializingContext()
        self.zmq_socket = self.zmq_context.socket(socketType)
+       if conflate:
+           self.zmq_socket.setsockopt(zmq.RCVHWM, 2)
        self.zmq_socket.setsockopt(zmq.SUBSCRIBE, b'')
        self.zmq_socket.connect(address)
 
+    def init_dealerrouter(self, address):
+        """ Initializes Hub in DEALER/ROUTER mode
+        """
+        socketType = zmq.ROUTER
+        self.zmq_context = SerializingContext()
+        self.zmq_socket = self.zmq_context.socket(socketType)
+        self.zmq_socket.bind(address)
+
+    def recv_envelope(self):
+        """In DEALER/ROUTER mode, receives the sender identity and frame sequence
+        that precede every message and remembers them for send_reply().
+        """
+        if self.mode == 'DEALER_ROUTER':
+            identity = self.zmq_socket.recv()
+            seq = self.zmq_socket.recv()
+            self.reply_to = (identity, seq)
+
     def connect(self, open_port):
         """In PUB/SUB mode, the hub can connect to multiple senders at the same
         time.
@@ -272,6 +593,10 @@ class ImageHub():
     def recv_image(self, copy=False):
         """Receives OpenCV image and text msg.
 
+        Frames sent through shared memory are copied out of the sender's
+        slot; a frame the sender overwrote before it was read is returned
+        as None.
+
         Arguments:
           copy: (optional) zmq copy flag.
 
@@ -280,7 +605,45 @@ class ImageHub():
           image: OpenCV image.
         """
 
+        if self.receiver is not None:
+            return self.get_latest()
+        msg, image = self.recv_frame()
+        if isinstance(image, JpgFrame):
+            image = image.decode()
+        return msg, image
+
+    def get_latest(self, timeout=None):
+        """Returns the newest frame received in conflate mode.
+
+        Waits for a frame newer than the one returned by the previous call.
+
+        Arguments:
+          timeout: (optional) seconds to wait, None waits indefinitely.
+
+        Returns:
+          msg: text msg, often the image name.
+          image: OpenCV image.
+          (None, None) if no new frame arrived within timeout.
+        """
+
+        if self.receiver is None:
+            raise TypeError("get_latest is available only in conflate mode.")
+        return self.receiver.get(timeout)
+
+    def recv_frame(self):
+        """Receives OpenCV image and text msg without decoding jpg frames.
+
+        Returns:
+          msg: text msg, often the image name.
+          image: OpenCV image, or a JpgFrame if the sender compressed it;
+                 decode() it only if the frame is actually used.
+        """
+
+        self.recv_envelope()
         msg, image = self.zmq_socket.recv_array(copy=False)
+        self.update_stats()
+        if self.zmq_socket.last_header.jpg:
+            image = JpgFrame(image)
         return msg, image
 
     def recv_jpg(self, copy=False):
@@ -293,24 +656,58 @@ class ImageHub():
           jpg_buffer: bytestring jpg compressed image
         """
 
+        self.recv_envelope()
         msg, jpg_buffer = self.zmq_socket.recv_jpg(copy=False)
+        self.update_stats()
         return msg, jpg_buffer
 
+    def update_stats(self, header=None):
+        """Updates frames_dropped and latency from the header of the last frame.
+
+        Gaps in the sequence numbers of a sender count as dropped frames.
+        Latency assumes the clocks of both computers are synchronised.
+        Legacy JSON headers carry neither, so they are skipped.
+
+        Arguments:
+          header: (optional) FrameHeader, defaults to the last received one.
+        """
+        if header is None:
+            header = self.zmq_socket.last_header
+        if header is None or header.seq is None:
+            return
+        last = self.last_seq.get(header.source_id)
+        if last is not None and header.seq > last + 1:
+            self.frames_dropped += header.seq - last - 1
+        self.last_seq[header.source_id] = header.seq
+        self.latency = time.time() - header.timestamp
+
     def send_reply(self, reply_message=b'OK'):
         """Sends the zmq REP reply message.
 
+        In DEALER/ROUTER mode the reply is routed back to the sender of the
+        last received image and acknowledges that frame.
+
         Arguments:
           reply_message: reply message text, often just string 'OK'
         """
-        self.zmq_socket.send(reply_message)
+        if self.mode == 'DEALER_ROUTER':
+            identity, seq = self.reply_to
+            self.zmq_socket.send_multipart([identity, seq, reply_message])
+            self.reply_to = None
+        else:
+            self.zmq_socket.send(reply_message)
 
     def close(self):
+      if self.receiver is not None:
+        # the receiver thread owns the socket, stop it first
+        self.receiver.stop()
       if self.mode == 'REQ_REP':
         # REQ/REP mode, this is a blocking scenario
         self.close_reqrep()
       else:
-        #PUB/SUB mode, non-blocking scenario
+        #PUB/SUB and DEALER/ROUTER mode, non-blocking scenario
         self.close_pubsub()
+      self.zmq_socket.detach_shm()
     
     def close_reqrep(self):
       self.zmq_socket.close()
@@ -319,6 +716,384 @@ class ImageHub():
       self.zmq_socket.close()
 
 
+class LatestFrameReceiver(threading.Thread):
+    """Receives frames of a conflating ImageHub in the background.
+
+    Whenever the socket is readable, all queued messages are received and
+    only the newest one is decoded and kept, so a slow consumer always gets
+    a frame at most one frame old. Skipped messages still update the drop and
+    latency statistics of the hub. The thread is the only user of the socket.
+
+    Arguments:
+      hub: the conflating ImageHub.
+      poll_ms: (optional) how often the thread checks whether it was stopped.
+    """
+
+    def __init__(self, hub, poll_ms=100):
+        super().__init__(daemon=True)
+        self.hub = hub
+        self.poll_ms = poll_ms
+        self.cond = threading.Condition()
+        self.running = True
+        self.latest = None          # (msg, image) of the newest frame
+        self.received = 0           # number of decoded frames
+        self.returned = 0           # value of received at the last get()
+        self.frames_conflated = 0   # frames skipped because a newer one was queued
+
+    def run(self):
+        """Receives until stopped."""
+        socket = self.hub.zmq_socket
+        while self.running:
+            if not socket.poll(self.poll_ms):
+                continue
+            parts, skipped = None, 0
+            while True:
+                try:
+                    newer = socket.recv_multipart(flags=zmq.NOBLOCK, copy=False)
+                except zmq.Again:
+                    break
+                if parts is not None:
+                    skipped += 1
+                    self.hub.update_stats(FrameHeader.unpack(parts[0]))
+                parts = newer
+            if parts is None:
+                continue
+            msg, image = socket.array_from_parts(parts)
+            self.hub.update_stats()
+            if image is None:
+                # shared memory slot already overwritten, keep the previous frame
+                continue
+            if socket.last_header.jpg:
+                image = JpgFrame(image).decode()
+            with self.cond:
+                self.latest = (msg, image)
+                self.received += 1
+                self.frames_conflated += skipped
+                self.cond.notify_all()
+
+    def get(self, timeout=None):
+        """Returns the newest frame once it is newer than the last returned one."""
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.received > self.returned, timeout):
+                return None, None
+            self.returned = self.received
+            return self.latest
+
+    def stop(self):
+        """Stops the thread and waits for it to finish."""
+        self.running = False
+        self.join()
+
+
+class AdaptiveJpegEncoder():
+    """Encodes frames to jpg in a thread pool and adapts to the link.
+
+    cv2.imencode releases the GIL, so several frames are encoded in parallel.
+    After every sent frame adapt() compares its size with the per-frame budget
+    (estimated bandwidth / target fps) and the number of frames waiting for
+    encoding: on congestion the quality is lowered first and the resolution
+    next, when there is headroom both are restored in the reverse order.
+
+    Arguments:
+      threads: number of encoding threads.
+      quality: initial jpg quality.
+      quality_lim: (min, max) jpg quality.
+      scale_lim: (min, max) resolution scale.
+      target_fps: frame rate the budget is computed for.
+    """
+
+    def __init__(self, threads=2, quality=80, quality_lim=(30, 95),
+                 scale_lim=(0.25, 1.0), target_fps=30.0):
+        """Starts the thread pool."""
+        self.threads = threads
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+        self.quality = quality
+        self.quality_lim = quality_lim
+        self.scale = scale_lim[1]
+        self.scale_lim = scale_lim
+        self.target_fps = target_fps
+        self.bandwidth = None   # bytes per second, moving average
+
+    def submit(self, image):
+        """Returns a future of the jpg buffer of image at the current settings."""
+        return self.pool.submit(self.encode, image, self.quality, self.scale)
+
+    @staticmethod
+    def encode(image, quality, scale):
+        """Downscales image if needed and encodes it to a jpg buffer."""
+        if scale < 1.0:
+            image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        success, jpg_buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, int(quality)])
+        if not success:
+            raise ValueError("Image could not be encoded to jpg.")
+        return jpg_buffer
+
+    def measure(self, nbytes, seconds):
+        """Updates the bandwidth estimate with nbytes transferred in seconds."""
+        if seconds is None or seconds <= 0:
+            return
+        rate = nbytes / seconds
+        if self.bandwidth is None:
+            self.bandwidth = rate
+        else:
+            self.bandwidth = 0.8*self.bandwidth + 0.2*rate
+
+    def adapt(self, nbytes, queue_depth):
+        """Adjusts quality and scale after a frame of nbytes was sent."""
+        budget = None if self.bandwidth is None else self.bandwidth / self.target_fps
+        congested = queue_depth >= self.threads or (budget is not None and nbytes > budget)
+        headroom = queue_depth == 0 and (budget is None or nbytes < 0.7*budget)
+        if congested:
+            if self.quality > self.quality_lim[0]:
+                self.quality = max(self.quality_lim[0], self.quality - 5)
+            else:
+                self.scale = max(self.scale_lim[0], self.scale * 0.75)
+        elif headroom:
+            if self.scale < self.scale_lim[1]:
+                self.scale = min(self.scale_lim[1], self.scale / 0.75)
+            else:
+                self.quality = min(self.quality_lim[1], self.quality + 1)
+
+    def close(self):
+        """Stops the thread pool."""
+        self.pool.shutdown(wait=False)
+
+
+class JpgFrame():
+    """A received jpg image that is decoded only when needed.
+
+    Frames the consumer skips are never decoded. A consumer that displays the
+    frame smaller than it was sent can decode it at 1/2, 1/4 or 1/8 size
+    directly, which is much cheaper than decoding and resizing afterwards.
+
+    Arguments:
+      jpg_buffer: the received jpg buffer.
+    """
+
+    REDUCE_FLAGS = {
+        1: cv2.IMREAD_COLOR,
+        2: cv2.IMREAD_REDUCED_COLOR_2,
+        4: cv2.IMREAD_REDUCED_COLOR_4,
+        8: cv2.IMREAD_REDUCED_COLOR_8,
+    }
+
+    def __init__(self, jpg_buffer):
+        self.jpg_buffer = jpg_buffer
+        self.images = {}        # reduce factor -> decoded image
+
+    def decode(self, reduce=1):
+        """Decodes the frame, every reduce factor is decoded only once.
+
+        Arguments:
+          reduce: (optional) 1, 2, 4 or 8; decodes directly at 1/reduce size.
+
+        Returns:
+          image: decoded OpenCV image.
+        """
+        image = self.images.get(reduce)
+        if image is None:
+            buffer = np.frombuffer(self.jpg_buffer, dtype=np.uint8)
+            image = cv2.imdecode(buffer, self.REDUCE_FLAGS[reduce])
+            if image is None:
+                raise ValueError("Received jpg could not be decoded.")
+            self.images[reduce] = image
+        return image
+
+
+class SharedFrameRing():
+    """A ring of shared memory slots that frames are written into.
+
+    Used by ImageSender when the hub is on the same host. The frame is copied
+    once into the next slot and only the slot name, dtype and shape travel
+    over zmq. Slots are reused after `slots` frames, so every slot starts with
+    the sequence number of the frame it holds (SLOT_STAMP). It is cleared
+    while the frame is written; the hub copies the frame out and keeps it only
+    if the stamp matched its header before and after the copy, so a slow hub
+    drops overwritten frames instead of reading torn ones.
+
+    Arguments:
+      slots: number of frames in the ring.
+    """
+
+    def __init__(self, slots=4):
+        """Prepares empty slots, memory is allocated on first use."""
+        if slots < 2:
+            raise ValueError("Shared memory ring needs at least 2 slots.")
+        self.slots = slots
+        self.blocks = [None] * slots
+        self.index = 0
+        self.generation = 0
+        self.prefix = f"imagezmq_{os.getpid()}_{id(self):x}"
+
+    def write(self, A, seq):
+        """Copies array A into the next slot and stamps it with seq.
+
+        Returns:
+          name: name of the shared memory block holding the array.
+        """
+        size = SLOT_STAMP.size + A.nbytes
+        block = self.blocks[self.index]
+        if block is None or block.size < size:
+            # first use or a larger resolution, the new name tells the hub to reattach
+            if block is not None:
+                block.close()
+                block.unlink()
+            self.generation += 1
+            block = shared_memory.SharedMemory(
+                name=f"{self.prefix}_{self.index}_{self.generation}",
+                create=True, size=size)
+            self.blocks[self.index] = block
+        SLOT_STAMP.pack_into(block.buf, 0, 0)
+        slot = np.ndarray(A.shape, dtype=A.dtype, buffer=block.buf, offset=SLOT_STAMP.size)
+        slot[...] = A
+        del slot
+        SLOT_STAMP.pack_into(block.buf, 0, seq)
+        self.index = (self.index + 1) % self.slots
+        return block.name
+
+    def close(self):
+        """Releases and unlinks all slots."""
+        for block in self.blocks:
+            if block is not None:
+                block.close()
+                block.unlink()
+        self.blocks = [None] * self.slots
+
+
+def default_source_id():
+    """Returns a source id unlikely to be used by any other sender.
+
+    Hubs count dropped frames per source id, so senders on several computers
+    or in several processes must not share one. The id is a 16 bit hash of
+    the hostname, the process id and a counter of the senders in the process.
+    """
+    key = f"{socket.gethostname()}-{os.getpid()}-{next(SOURCE_COUNTER)}"
+    return zlib.crc32(key.encode('utf-8')) & 0xFFFF
+
+
+def read_shared_frame(block, header):
+    """Returns a copy of the frame described by header, None if it was overwritten.
+
+    The stamp is checked before and after the copy, a frame the sender
+    started to overwrite meanwhile is dropped rather than returned torn.
+    """
+    if SLOT_STAMP.unpack_from(block.buf, 0)[0] != header.seq:
+        return None
+    A = np.ndarray(header.shape, dtype=header.dtype, buffer=block.buf,
+                   offset=SLOT_STAMP.size).copy()
+    if SLOT_STAMP.unpack_from(block.buf, 0)[0] != header.seq:
+        return None
+    return A
+
+
+def attach_shared_memory(name):
+    """Attaches to an existing shared memory block without taking ownership.
+
+    The sender unlinks its slots, so the hub must not register them with the
+    resource tracker (which would unlink them when the hub exits).
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13 has no track argument
+        block = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(block._name, 'shared_memory')
+        return block
+
+
+# Counts the senders created in this process, part of their default source id.
+SOURCE_COUNTER = itertools.count()
+
+# Sequence number stamped in front of every shared memory frame.
+SLOT_STAMP = struct.Struct('<Q')
+
+# Binary frame header: version, dtype code, ndim, flags, source id, msg length,
+# shm name length, sequence number, capture timestamp; followed by ndim uint32
+# shape values, the utf-8 msg and the utf-8 shm name.
+HEADER_VERSION = 1
+HEADER_STRUCT = struct.Struct('<BBBBHHHQd')
+FLAG_SHM = 0x01
+FLAG_JPG = 0x02
+DTYPE_CODES = {
+    np.dtype('uint8'): 1, np.dtype('int8'): 2,
+    np.dtype('uint16'): 3, np.dtype('int16'): 4,
+    np.dtype('uint32'): 5, np.dtype('int32'): 6,
+    np.dtype('uint64'): 7, np.dtype('int64'): 8,
+    np.dtype('float16'): 9, np.dtype('float32'): 10,
+    np.dtype('float64'): 11, np.dtype('bool'): 12,
+}
+DTYPES = {code: dtype for dtype, code in DTYPE_CODES.items()}
+
+
+class FrameHeader():
+    """Metadata sent in front of every frame.
+
+    Packed into a compact fixed layout instead of JSON. Legacy JSON headers
+    (they start with '{', the binary version byte never does) are still
+    decoded, their seq and timestamp are None.
+
+    Attributes:
+      msg: text message, often the image name.
+      dtype: numpy dtype of the array, None for jpg buffers.
+      shape: shape of the array.
+      seq: sequence number of the frame at its sender.
+      timestamp: capture time (time.time()) of the frame.
+      source_id: number identifying the sender.
+      shm: name of the shared memory slot holding the frame, or None.
+      jpg: True if the payload is a jpg buffer.
+    """
+
+    def __init__(self, msg='NoName', dtype=None, shape=(), seq=None,
+                 timestamp=None, source_id=0, shm=None, jpg=False):
+        self.msg = msg
+        self.dtype = None if dtype is None else np.dtype(dtype)
+        self.shape = tuple(shape)
+        self.seq = seq
+        self.timestamp = timestamp
+        self.source_id = source_id
+        self.shm = shm
+        self.jpg = jpg
+
+    def pack(self):
+        """Returns the header as bytes."""
+        if self.dtype is None:
+            dtype_code = 0
+        elif self.dtype in DTYPE_CODES:
+            dtype_code = DTYPE_CODES[self.dtype]
+        else:
+            raise ValueError(f"dtype {self.dtype} can not be sent")
+        msg = self.msg.encode('utf-8')
+        shm = b'' if self.shm is None else self.shm.encode('utf-8')
+        flags = (FLAG_SHM if self.shm is not None else 0) | (FLAG_JPG if self.jpg else 0)
+        fixed = HEADER_STRUCT.pack(HEADER_VERSION, dtype_code, len(self.shape), flags,
+                                   self.source_id, len(msg), len(shm),
+                                   self.seq or 0, self.timestamp or 0.0)
+        shape = struct.pack(f'<{len(self.shape)}I', *self.shape)
+        return b''.join((fixed, shape, msg, shm))
+
+    @classmethod
+    def unpack(cls, buffer):
+        """Returns a FrameHeader decoded from bytes in binary or legacy JSON form."""
+        buffer = bytes(buffer)
+        if buffer[:1] == b'{':
+            md = json.loads(buffer)
+            return cls(msg=md['msg'], dtype=md.get('dtype'), shape=md.get('shape', ()),
+                       shm=md.get('shm'), jpg='dtype' not in md)
+        (version, dtype_code, ndim, flags, source_id,
+         msg_len, shm_len, seq, timestamp) = HEADER_STRUCT.unpack_from(buffer)
+        if version != HEADER_VERSION:
+            raise ValueError(f"Unsupported frame header version {version}")
+        offset = HEADER_STRUCT.size
+        shape = struct.unpack_from(f'<{ndim}I', buffer, offset)
+        offset += 4 * ndim
+        msg = buffer[offset:offset + msg_len].decode('utf-8')
+        offset += msg_len
+        shm = buffer[offset:offset + shm_len].decode('utf-8') if flags & FLAG_SHM else None
+        return cls(msg=msg, dtype=DTYPES.get(dtype_code), shape=shape, seq=seq,
+                   timestamp=timestamp, source_id=source_id, shm=shm,
+                   jpg=bool(flags & FLAG_JPG))
+
+
 class SerializingSocket(zmq.Socket):
     """Numpy array serialization methods.
 
@@ -326,9 +1101,30 @@ class SerializingSocket(zmq.Socket):
 
     Used for sending / receiving OpenCV images, which are Numpy arrays.
     Also used for sending / receiving jpg compressed OpenCV images.
+    Every frame is preceded by a binary FrameHeader.
     """
 
-    def send_array(self, A, msg='NoName', flags=0, copy=True, track=False):
+    # attributes are declared on the class, zmq treats unknown ones as socket options
+    shm_blocks = None       # (name, block) attached by recv_array, keyed by ring slot
+    shm_stale = 0           # shared memory frames dropped because they were overwritten
+    sequence = 0            # sequence number of the last sent frame
+    source_id = 0           # sent in every header to identify this sender
+    last_header = None      # FrameHeader of the last received frame
+
+    def make_header(self, msg, timestamp, **kwargs):
+        """Returns the FrameHeader for the next sent frame."""
+        self.sequence += 1
+        if timestamp is None:
+            timestamp = time.time()
+        return FrameHeader(msg=msg, seq=self.sequence, timestamp=timestamp,
+                           source_id=self.source_id, **kwargs)
+
+    def recv_header(self, flags=0):
+        """Receives and remembers the FrameHeader of the next frame."""
+        self.last_header = FrameHeader.unpack(self.recv(flags=flags))
+        return self.last_header
+
+    def send_array(self, A, msg='NoName', flags=0, copy=True, track=False, timestamp=None):
         """Sends a numpy array with metadata and text message.
 
         Sends a numpy array with the metadata necessary for reconstructing
@@ -341,14 +1137,11 @@ class SerializingSocket(zmq.Socket):
           flags: (optional) zmq flags.
           copy: (optional) zmq copy flag.
           track: (optional) zmq track flag.
+          timestamp: (optional) capture time of the array, defaults to now.
         """
 
-        md = dict(
-            msg=msg,
-            dtype=str(A.dtype),
-            shape=A.shape,
-        )
-        self.send_json(md, flags | zmq.SNDMORE)
+        header = self.make_header(msg, timestamp, dtype=A.dtype, shape=A.shape)
+        self.send(header.pack(), flags | zmq.SNDMORE)
         return self.send(A, flags, copy=copy, track=track)
 
     def send_jpg(self,
@@ -356,7 +1149,8 @@ class SerializingSocket(zmq.Socket):
                  jpg_buffer=b'00',
                  flags=0,
                  copy=True,
-                 track=False):
+                 track=False,
+                 timestamp=None):
         """Send a jpg buffer with a text message.
 
         Sends a jpg bytestring of an OpenCV image.
@@ -368,10 +1162,11 @@ class SerializingSocket(zmq.Socket):
           flags: (optional) zmq flags.
           copy: (optional) zmq copy flag.
           track: (optional) zmq track flag.
+          timestamp: (optional) capture time of the image, defaults to now.
         """
 
-        md = dict(msg=msg, )
-        self.send_json(md, flags | zmq.SNDMORE)
+        header = self.make_header(msg, timestamp, jpg=True)
+        self.send(header.pack(), flags | zmq.SNDMORE)
         return self.send(jpg_buffer, flags, copy=copy, track=track)
 
     def recv_array(self, flags=0, copy=True, track=False):
@@ -380,6 +1175,7 @@ class SerializingSocket(zmq.Socket):
         Receives a numpy array with the metadata necessary
         for reconstructing the array (dtype,shape).
         Returns the array and a text msg, often the array or image name.
+        The full header is kept in last_header.
 
         Arguments:
           flags: (optional) zmq flags.
@@ -388,13 +1184,81 @@ class SerializingSocket(zmq.Socket):
 
         Returns:
           msg: image name or text message.
-          A: numpy array or OpenCV image reconstructed with dtype and shape.
+          A: numpy array or OpenCV image reconstructed with dtype and shape,
+             the undecoded buffer if a jpg was sent.
         """
 
-        md = self.recv_json(flags=flags)
-        msg = self.recv(flags=flags, copy=copy, track=track)
-        A = np.frombuffer(msg, dtype=md['dtype'])
-        return (md['msg'], A.reshape(md['shape']))
+        parts = self.recv_multipart(flags=flags, copy=copy, track=track)
+        return self.array_from_parts(parts)
+
+    def array_from_parts(self, parts):
+        """Reconstructs the array from the parts of one received message.
+
+        Arguments:
+          parts: list of message parts, the FrameHeader first.
+
+        Returns:
+          msg: image name or text message.
+          A: numpy array, copy of a shared memory slot (None if the sender
+             overwrote it before it was read), or the undecoded buffer if a
+             jpg was sent.
+        """
+
+        header = FrameHeader.unpack(parts[0])
+        self.last_header = header
+        if header.jpg:
+            # compressed payload, decoding is left to the caller
+            return (header.msg, parts[1])
+        if header.shm is not None:
+            # the array is in a shared memory slot, copy it out while it is valid
+            A = read_shared_frame(self.attach_shm(header.shm), header)
+            if A is None:
+                self.shm_stale += 1
+            return (header.msg, A)
+        A = np.frombuffer(parts[1], dtype=header.dtype)
+        return (header.msg, A.reshape(header.shape))
+
+    def send_shm_array(self, ring, A, msg='NoName', flags=0, timestamp=None):
+        """Sends a numpy array through shared memory.
+
+        Writes the array into the next slot of ring and sends only the
+        metadata needed to find and reconstruct it (slot name, dtype, shape).
+
+        Arguments:
+          ring: SharedFrameRing owned by the sender.
+          A: numpy array or OpenCV image.
+          msg: (optional) array name, image name or text message.
+          flags: (optional) zmq flags.
+          timestamp: (optional) capture time of the array, defaults to now.
+        """
+
+        header = self.make_header(msg, timestamp, dtype=A.dtype, shape=A.shape)
+        header.shm = ring.write(A, header.seq)
+        return self.send(header.pack(), flags)
+
+    def attach_shm(self, name):
+        """Returns the shared memory block called name, attaching to it once.
+
+        Names end with the generation of their ring slot, the block of an
+        older generation of the same slot is closed when a new one appears.
+        """
+        if self.shm_blocks is None:
+            self.shm_blocks = {}
+        slot = name.rsplit('_', 1)[0]
+        attached = self.shm_blocks.get(slot)
+        if attached is not None and attached[0] == name:
+            return attached[1]
+        if attached is not None:
+            attached[1].close()
+        block = attach_shared_memory(name)
+        self.shm_blocks[slot] = (name, block)
+        return block
+
+    def detach_shm(self):
+        """Closes all attached shared memory blocks."""
+        for name, block in (self.shm_blocks or {}).values():
+            block.close()
+        self.shm_blocks = {}
 
     def recv_jpg(self, flags=0, copy=True, track=False):
         """Receives a jpg buffer and a text msg.
@@ -412,9 +1276,9 @@ class SerializingSocket(zmq.Socket):
           jpg_buffer: bytestring, containing jpg image.
         """
 
-        md = self.recv_json(flags=flags)  # metadata text
+        header = self.recv_header(flags=flags)
         jpg_buffer = self.recv(flags=flags, copy=copy, track=track)
-        return (md['msg'], jpg_buffer)
+        return (header.msg, jpg_buffer)
 
 
 class SerializingContext(zmq.Context):